@@ -0,0 +1,76 @@
+import csv
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger("aircraft_registry")
+
+# sqlite index over Junzi Sun's aircraft_db.csv, keyed by ICAO hex code
+#  built once from the csv and only rebuilt when the csv changes, so lookups are a primary key probe and we never
+#  have to hold the whole csv in memory
+
+
+class AircraftRegistry:
+    def __init__(self, index_name):
+        self.conn = sqlite3.connect(index_name, check_same_thread=False)
+        # lookups come from the enrichment worker threads
+        self.lock = threading.Lock()
+
+    def lookup(self, icao):
+        # returns the registration (regid) for this hex code, or None if it isn't in the db
+        #  a blank regid (from an index built before those rows were skipped) is as good as not being there
+        with self.lock:
+            row = self.conn.execute("select regid from registry where icao = (?)", [icao]).fetchone()
+        if row is None or row[0] is None or row[0].strip() == '':
+            return None
+        return row[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def csv_signature(csv_name):
+    # cheap way to tell whether the csv has been replaced since the index was built
+    stat = os.stat(csv_name)
+    return str(stat.st_size) + ":" + str(int(stat.st_mtime))
+
+
+def build_index(csv_name, index_name):
+    logger.info("Building aircraft registry index from %s", csv_name)
+    conn = sqlite3.connect(index_name)
+    conn.execute("drop table if exists registry")
+    conn.execute("create table if not exists meta (key text primary key, value text)")
+    conn.execute("create table registry (icao text primary key, regid text) without rowid")
+
+    # stream the csv straight into the index rather than loading it all up front
+    #  rows with no registration are left out, so those aircraft count as unknown instead of getting a blank ident
+    with open(csv_name, newline='', encoding='utf-8', errors='replace') as csv_file:
+        reader = csv.DictReader(csv_file)
+        rows = ((row['icao'], row['regid']) for row in reader
+                if row.get('icao') and (row.get('regid') or '').strip())
+        conn.executemany("insert or replace into registry values (?,?)", rows)
+
+    conn.execute("insert or replace into meta values ('csv_signature', ?)", [csv_signature(csv_name)])
+    conn.commit()
+    count = conn.execute("select count(*) from registry").fetchone()[0]
+    conn.close()
+    logger.info("Aircraft registry index built with %d aircraft", count)
+
+
+def open_registry(csv_name, index_name):
+    # rebuild the index if it doesn't exist yet, or the csv has changed since it was built
+    signature = csv_signature(csv_name)
+    current = None
+    if os.path.exists(index_name):
+        try:
+            conn = sqlite3.connect(index_name)
+            row = conn.execute("select value from meta where key = 'csv_signature'").fetchone()
+            conn.close()
+            if row is not None:
+                current = row[0]
+        except sqlite3.Error:
+            current = None
+    if current != signature:
+        build_index(csv_name, index_name)
+    return AircraftRegistry(index_name)
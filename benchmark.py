@@ -0,0 +1,287 @@
+import argparse
+import datetime
+import http.server
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import constants
+import database
+import helper_functions
+import http_client
+import metrics
+import sessions
+import tracks
+import weather
+import tweet_dispatcher
+# main.py's poll loop, one cycle at a time
+import main as pipeline
+
+# drives main.py's own poll cycle against recorded or synthetic aircraft.json snapshots, with local stub servers
+#  standing in for dump1090, FlightAware, FXML, OWM, bitly and twitter. Timings come from the same metrics stages
+#  main.py reports, and are printed and appended to benchmark_results.jsonl so runs can be compared over time
+# usage: python3 benchmark.py [--sizes 10 100 1000] [--latency 0.05] [--cycles 5] [--snapshot aircraft.json ...]
+
+# main.py's metrics stages, then the wait for the background tweet dispatcher
+stages = ["weather", "fetch", "parse", "distance_filter", "dedup", "enrichment", "prediction", "db_commit", "tweet",
+          "cycle", "tweet_dispatch"]
+
+
+class StubState:
+    # what the stub servers hand out. snapshot is the current aircraft.json body
+    snapshot = b'{"now": 0, "messages": 0, "aircraft": []}'
+    latency = 0.0
+    calls = {}
+    calls_lock = threading.Lock()
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out as separate writes. Without this, delayed ACKs add ~40ms to every keep-alive request
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data):
+        body = data if isinstance(data, bytes) else json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(body.__len__()))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        parts = url.path.strip('/').split('/')
+        endpoint = parts[1] if parts[0] in ('live', 'FlightXML3') else parts[0]
+        with StubState.calls_lock:
+            StubState.calls[endpoint] = StubState.calls.get(endpoint, 0) + 1
+
+        # dump1090 is local, so no simulated latency for the feed itself
+        if url.path == '/data/aircraft.json':
+            self.send_json(StubState.snapshot)
+            return
+        time.sleep(StubState.latency)
+
+        if parts[0] == 'live' and parts[1] == 'modes':
+            # every third aircraft is unknown to FlightAware, the rest redirect to a flight page
+            icao = parts[2]
+            if int(icao, 16) % 3 == 0:
+                self.send_json(b'unknown')
+            else:
+                self.send_response(302)
+                self.send_header("Location", "/live/flight/TST" + str(int(icao, 16) % 1000))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+        elif parts[0] == 'live':
+            self.send_json(b'flight page')
+        elif endpoint == 'FlightInfoStatus':
+            airport = {'airport_name': 'Edmonton Intl', 'code': 'CYEG'}
+            self.send_json({'FlightInfoStatusResult': {'flights': [
+                {'progress_percent': 50, 'aircrafttype': 'B738', 'airline': 'TST', 'airline_iata': 'TS',
+                 'flightnumber': params.get('ident', 'TST1'), 'tailnumber': 'C-TEST', 'origin': airport,
+                 'destination': {'airport_name': 'Calgary Intl', 'code': 'CYYC'}}]}})
+        elif endpoint == 'AirlineInfo':
+            self.send_json({'AirlineInfoResult': {'callsign': 'TEST', 'country': 'Canada', 'location': 'YEG',
+                                                  'name': 'Test Air', 'phone': '', 'shortname': 'Test',
+                                                  'url': ''}})
+        elif endpoint == 'AircraftType':
+            self.send_json({'AircraftTypeResult': {'description': 'landplane', 'engine_count': 2,
+                                                   'engine_type': 'Jet', 'manufacturer': 'Boeing',
+                                                   'type': '737-800'}})
+        elif endpoint == 'TailOwner':
+            self.send_json({'TailOwnerResult': {'location': 'YEG', 'location2': '', 'owner': 'Test',
+                                                'website': ''}})
+        elif endpoint == 'weather':
+            self.send_json({'dt': int(time.time()), 'coord': {'lat': constants.my_lat, 'lon': constants.my_lon},
+                            'weather': [{'description': 'clear sky'}],
+                            'main': {'temp': 10, 'pressure': 1013, 'humidity': 50}, 'visibility': 10000})
+        else:
+            # bitly and twitter
+            self.send_json({'ok': True})
+
+
+class StubShortener:
+    # stands in for bitlyshortener, with the same round trip cost as the other stubs
+    def __init__(self, base):
+        self.base = base
+
+    def shorten_urls(self, urls):
+        http_client.get(self.base + "bitly/shorten")
+        return [self.base + "b/" + str(abs(hash(url)) % 100000) for url in urls]
+
+
+class StubTwitter:
+    def __init__(self, base):
+        self.base = base
+
+    def update_status(self, status):
+        return http_client.get(self.base + "twitter/update").json()
+
+
+def synthetic_snapshot(count, now, seed):
+    # aircraft scattered over twice our airspace radius, so roughly a quarter of them are inside it
+    generator = random.Random(seed)
+    lat_span = constants.airspace_radius_km * 2 / 111.0
+    lon_span = lat_span / max(0.01, math.cos(math.radians(constants.my_lat)))
+    aircraft = []
+    for index in range(count):
+        icao = format(0xC00000 + index, '06x')
+        airplane = {'hex': icao,
+                    'lat': constants.my_lat + generator.uniform(-lat_span, lat_span),
+                    'lon': constants.my_lon + generator.uniform(-lon_span, lon_span),
+                    'alt_baro': generator.randint(1000, 40000),
+                    'gs': generator.uniform(100, 500),
+                    'track': generator.uniform(0, 360),
+                    'seen': 0.5}
+        if index % 2:
+            airplane['flight'] = "TST" + str(index) + " "
+        if index % 4 == 0:
+            airplane['squawk'] = str(1000 + index % 7000)
+        aircraft.append(airplane)
+    return {'now': now, 'messages': int(now * 10), 'aircraft': aircraft}
+
+
+def moved_snapshot(snapshot, now):
+    # every aircraft moves a little, as they would between real polls
+    moved = {'now': now, 'messages': int(now * 10), 'aircraft': []}
+    for airplane in snapshot['aircraft']:
+        airplane = dict(airplane)
+        if 'lat' in airplane:
+            airplane['lat'] += 0.001
+            airplane['lon'] += 0.001
+        moved['aircraft'].append(airplane)
+    return moved
+
+
+def reset_pipeline(db_name):
+    helper_functions.discard_prefetches([])
+    tracks.open_tracks.clear()
+    database.close_connection()
+    constants.db_name = db_name
+    helper_functions.unknown_aircraft.clear()
+    helper_functions.short_links.clear()
+    pipeline.last_snapshot = None
+    pipeline.last_positions.clear()
+    pipeline.poll_interval = constants.sleep_time
+    helper_functions.create_sql_tables()
+    sessions.load()
+    weather.load()
+
+
+def count_sightings():
+    with database.lock:
+        return database.get_connection().execute("select count(*) from sightings").fetchone()[0]
+
+
+def run_cycle(snapshot):
+    # one pass of main.py's loop, timed stage by stage
+    StubState.snapshot = json.dumps(snapshot).encode('utf-8')
+    sightings = count_sightings()
+    before = metrics.stage_totals()
+    pipeline.poll_cycle(None)
+    after = metrics.stage_totals()
+    timings = {stage: after[stage] - before.get(stage, 0.0) for stage in after}
+
+    # the dispatcher runs in the background in main.py. Here we wait for it so its cost is visible too
+    started = time.perf_counter()
+    while tweet_dispatcher.pending.__len__() and time.perf_counter() - started < 60:
+        time.sleep(0.001)
+    timings['tweet_dispatch'] = time.perf_counter() - started
+
+    counts = {'aircraft': snapshot['aircraft'].__len__(),
+              'in_range': helper_functions.filter_airspace(snapshot['aircraft']).__len__(),
+              'added': count_sightings() - sightings}
+    return {stage: round(timings.get(stage, 0.0) * 1000, 3) for stage in stages}, counts
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark one poll cycle of the piaware-alerts pipeline")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000],
+                        help="number of aircraft in each synthetic snapshot")
+    parser.add_argument("--snapshot", nargs="+", default=[], help="recorded aircraft.json files to use instead")
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated upstream latency in seconds")
+    parser.add_argument("--cycles", type=int, default=5, help="warm cycles to run after the first (cold) one")
+    parser.add_argument("--output", default="benchmark_results.jsonl", help="where to append the results")
+    args = parser.parse_args()
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = "http://127.0.0.1:" + str(server.server_address[1]) + "/"
+    StubState.latency = args.latency
+
+    # point everything at the stubs, and take the brakes off the tweet rate limiter
+    constants.live_data_url = base + "data/aircraft.json"
+    constants.flightaware_url = base + "live/"
+    constants.fxmlUrl = base + "FlightXML3/"
+    constants.OWM_URL = base + "weather"
+    constants.tweet_burst = 1000000
+    constants.tweet_refill_seconds = 0.000001
+    helper_functions.link_shortener = StubShortener(base)
+    helper_functions.twitter_client = StubTwitter(base)
+    helper_functions.email_problem = lambda reason: None
+    tweet_dispatcher.start()
+
+    if args.snapshot:
+        scenarios = []
+        for name in args.snapshot:
+            with open(name, 'rb') as snapshot_file:
+                scenarios.append((name, json.loads(snapshot_file.read())))
+    else:
+        scenarios = [("synthetic-" + str(size), synthetic_snapshot(size, time.time(), size)) for size in args.sizes]
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name, snapshot in scenarios:
+            constants.tweet_batch_size = max(10, snapshot['aircraft'].__len__())
+            reset_pipeline(os.path.join(work_dir, name.replace('/', '_') + ".db"))
+            StubState.calls = {}
+            cold, cold_counts = run_cycle(snapshot)
+            warm_runs = []
+            for cycle in range(args.cycles):
+                snapshot = moved_snapshot(snapshot, snapshot['now'] + constants.sleep_time)
+                warm_runs.append(run_cycle(snapshot)[0])
+            warm = {stage: round(sum(run[stage] for run in warm_runs) / max(1, warm_runs.__len__()), 3)
+                    for stage in stages}
+            results.append({'scenario': name, 'counts': cold_counts, 'cold_ms': cold, 'warm_ms': warm,
+                            'upstream_calls': dict(StubState.calls)})
+
+            print(name + ": " + str(cold_counts['aircraft']) + " aircraft, " + str(cold_counts['in_range']) +
+                  " in range, " + str(cold_counts['added']) + " added")
+            print("  " + "stage".ljust(16) + "cold ms".rjust(12) + "warm ms".rjust(12))
+            for stage in stages:
+                print("  " + stage.ljust(16) + str(cold[stage]).rjust(12) + str(warm[stage]).rjust(12))
+
+    tweet_dispatcher.stop(1)
+    database.close_connection()
+    server.shutdown()
+
+    record = {'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+              'revision': git_revision(),
+              'python': sys.version.split()[0],
+              'latency_s': args.latency,
+              'cycles': args.cycles,
+              'results': results}
+    with open(args.output, 'a') as output_file:
+        output_file.write(json.dumps(record) + "\n")
+    print("Results appended to " + args.output)
+
+
+if __name__ == "__main__":
+    main()
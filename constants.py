@@ -1,60 +1,158 @@
-
-# name of database to store historical information
-db_name = "piplanes.db"
-
-# the aircraft DB file should only be used if the user is licensed for FR24, since that's the original data source
-# set this value to True if you're feeding FR24 as well. Leave as False otherwise
-fr24_licensed = False
-
-# name of csv file containing mappings of ICAO hex IDs to unique aircraft idents
-aircraft_db_name = "aircraft_db.csv"
-
-# pi-aware local JSON feed with cleansed input
-live_data_url = "http://192.168.1.207:8080/dump1090-fa/data/aircraft.json"
-
-# basic conversions
-knots_to_kph = 1.852
-meters_to_feet = 3.28084
-
-# antenna location
-my_lat = 53.7
-my_lon = -113.3
-home = (my_lat, my_lon)
-
-# how big of a range do we want to report on
-airspace_radius_km = 20
-
-# how long to wait between polling the antenna data
-sleep_time = 10
-
-# how long of a window to allow the squawk to changes from a value to none
- # this prevents duplicate entries
-squawk_delay = 900
-
-# open weather map settings
-OWM_key = "open weather map api key"
-OWM_URL = "https://api.openweathermap.org/data/2.5/weather?lat="+str(my_lat)+"&lon="+str(my_lon)+"&units=metric&APPID="+OWM_key
-weather_interval = 1800
-weather_api_check_frequency = 600
-
-# flightaware keys
-fxml_key = "flightxml api key"
-fa_username = "flightaware username"
-fxmlUrl = "https://flightxml.flightaware.com/json/FlightXML3/"
-fxml_flightinfo_limit = 15
-
-# twitter details
-twitter_app_key = "consumer key"
-twitter_app_secret = "consumer secret"
-twitter_token = "access token"
-twitter_token_secret = "access token secret"
-
-# bitly details
-bitly_token = "bitly token"
-
-#SMTP info
-smtp_server = "smtp.server.com"
-smtp_port = 25
-send_to = "you@providerX.com"
-send_from = "piaware-donotreply@providerY.com"
+
+# name of database to store historical information
+db_name = "piplanes.db"
+# how many prepared statements the shared connection keeps cached, and how much page cache (KiB) it may use
+db_cached_statements = 64
+db_cache_kb = 8192
+# writes are buffered and committed once per poll cycle. Flush early if this many pile up
+db_max_pending_writes = 500
+
+# the aircraft DB file should only be used if the user is licensed for FR24, since that's the original data source
+# set this value to True if you're feeding FR24 as well. Leave as False otherwise
+fr24_licensed = False
+
+# name of csv file containing mappings of ICAO hex IDs to unique aircraft idents
+aircraft_db_name = "aircraft_db.csv"
+# indexed copy of the csv above, rebuilt automatically whenever the csv changes
+aircraft_db_index_name = "aircraft_db_index.db"
+
+# pi-aware local JSON feed with cleansed input
+live_data_url = "http://192.168.1.207:8080/dump1090-fa/data/aircraft.json"
+
+# how to get aircraft data. "poll" reads live_data_url every sleep_time seconds, "sbs" streams dump1090's SBS-1
+#  output (sbs_host:sbs_port) and reacts as soon as an aircraft moves into our airspace
+ingest_mode = "poll"
+sbs_host = "192.168.1.207"
+sbs_port = 30003
+# streamed position updates are gathered up and processed this often (seconds)
+sbs_batch_interval = 2
+# forget streamed aircraft we haven't heard from in this long (seconds)
+sbs_aircraft_timeout = 300
+# wait this long (seconds) before reconnecting if the stream drops
+sbs_reconnect_delay = 10
+
+# shared HTTP connection pool. Timeouts are in seconds
+http_connect_timeout = 5
+http_read_timeout = 20
+http_pool_hosts = 8
+http_pool_size = 4
+
+# basic conversions
+knots_to_kph = 1.852
+meters_to_feet = 3.28084
+
+# antenna location
+my_lat = 53.7
+my_lon = -113.3
+home = (my_lat, my_lon)
+
+# how big of a range do we want to report on
+airspace_radius_km = 20
+
+# mean earth radius used by the fast haversine airspace filter
+earth_radius_km = 6371.0088
+# aircraft within this fraction of the airspace radius from the edge get an exact geodesic distance check
+#  haversine on the mean radius is off by up to ~0.56% (north-south near the equator), so keep this above 0.0056
+geodesic_refine_margin = 0.006
+
+# how long to wait between polling the antenna data
+sleep_time = 10
+# the poll interval adapts to the traffic. Poll every poll_interval_min seconds while anything is within
+#  airspace_edge_band_km outside our airspace, and slow down to poll_interval_max when nothing is within
+#  airspace_quiet_band_km of it. Otherwise use sleep_time
+poll_interval_min = 3
+poll_interval_max = 30
+airspace_edge_band_km = 10
+airspace_quiet_band_km = 50
+
+# how long of a window to allow the squawk to changes from a value to none
+ # this prevents duplicate entries
+squawk_delay = 900
+
+# open weather map settings
+OWM_key = "open weather map api key"
+OWM_URL = "https://api.openweathermap.org/data/2.5/weather?lat="+str(my_lat)+"&lon="+str(my_lon)+"&units=metric&APPID="+OWM_key
+weather_interval = 1800
+weather_api_check_frequency = 600
+
+# flightaware's live tracking pages. Used for the hex code redirect lookup and the links in tweets
+flightaware_url = "https://flightaware.com/live/"
+
+# flightaware keys
+fxml_key = "flightxml api key"
+fa_username = "flightaware username"
+fxmlUrl = "https://flightxml.flightaware.com/json/FlightXML3/"
+fxml_flightinfo_limit = 15
+# how many newly seen aircraft can be looked up on FlightAware/FXML at the same time
+enrichment_workers = 4
+# start looking up aircraft that are projected (from their speed and track) to enter our airspace within this many
+#  seconds, so the tweet can go out as they arrive. 0 turns this off. At most prefetch_limit are looked up early at once
+prefetch_horizon = 90
+prefetch_limit = 8
+# how long (seconds) to keep FlightInfoStatus responses. Short while a flight is in progress (or none is active yet,
+#  or FXML sent back no result at all), long once they're all done
+fxml_cache_ttl_in_progress = 900
+fxml_cache_ttl_completed = 86400
+# an aircraft's pass through our airspace is over (and its track written out) once we've gone this many seconds
+#  without an in-range position for it
+track_exit_timeout = 60
+# write a track out early if it gets this long, so an aircraft that hangs around all day can't use up the memory
+track_max_points = 4096
+
+# how long (seconds) to skip an ICAO hex code that FlightAware and the FR24 db couldn't resolve
+unknown_aircraft_ttl = 1800
+
+# twitter details
+twitter_app_key = "consumer key"
+twitter_app_secret = "consumer secret"
+twitter_token = "access token"
+twitter_token_secret = "access token secret"
+
+# how many untweeted aircraft to work through each poll cycle
+tweet_batch_size = 10
+# tweet rate limiting. Up to tweet_burst tweets at once, then one every tweet_refill_seconds
+#  (twitter allows 300 status updates every 3 hours, i.e. one every 36 seconds on average)
+tweet_burst = 5
+tweet_refill_seconds = 36
+# failed tweets are retried this many times in total, doubling the delay (seconds) between attempts
+tweet_max_attempts = 4
+tweet_retry_delay = 5
+# how long to wait for queued tweets to go out when shutting down
+tweet_shutdown_timeout = 15
+# appended to the end of every tweet
+hashtags = "#piaware #ADSB"
+
+# bitly details
+bitly_token = "bitly token"
+
+# runtime metrics in Prometheus text format. Served on http://metrics_host:metrics_port/metrics (port 0 turns this
+#  off) and/or written to metrics_file every poll cycle (empty string turns this off)
+metrics_host = "127.0.0.1"
+metrics_port = 9105
+metrics_file = ""
+
+# tweet a summary of the previous day's traffic once a day, at the first poll after daily_summary_hour (local time)
+daily_summary_tweet = False
+daily_summary_hour = 8
+# sightings read at a time when rebuilding the traffic stats from scratch
+stats_rebuild_chunk = 10000
+
+# logging. Levels are the standard DEBUG/INFO/WARNING/ERROR. Per-aircraft detail is logged at DEBUG, INFO gets one
+#  summary line per poll cycle. Log lines go out through a queue so the poll loop never waits on the terminal or disk
+log_level = "INFO"
+# also log to this file, rotated at log_file_max_bytes and keeping log_file_backups old copies (empty string turns
+#  this off)
+log_file = ""
+log_file_max_bytes = 5000000
+log_file_backups = 3
+# log lines waiting to be written. Anything beyond this is dropped (and counted) rather than holding up the loop
+log_queue_size = 10000
+# the same warning or error is only logged once in this many seconds, with a count of the repeats
+log_repeat_interval = 300
+
+#SMTP info
+smtp_server = "smtp.server.com"
+smtp_port = 25
+send_to = "you@providerX.com"
+send_from = "piaware-donotreply@providerY.com"
 subject = "PiAware Alerts Issue"
\ No newline at end of file
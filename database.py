@@ -0,0 +1,250 @@
+import logging
+import sqlite3
+import threading
+import constants
+
+logger = logging.getLogger("database")
+
+# one connection is shared for the life of the process. Opening and closing a connection for every query means
+#  re-reading the schema and an extra fsync each time, which adds up quickly on an SD card
+_connection = None
+# the connection is shared with the enrichment worker threads. Hold this while using it
+lock = threading.RLock()
+
+# writes queued up during a poll cycle, as (statement, values) pairs in the order they were made
+#  they all go out in a single transaction when flush() is called, rather than one commit (and fsync) per row
+_pending_writes = []
+
+
+def get_connection():
+    global _connection
+    with lock:
+        if _connection is None:
+            _connection = sqlite3.connect(constants.db_name, check_same_thread=False,
+                                          cached_statements=constants.db_cached_statements)
+            # WAL lets readers (e.g. the nightly backup) work while the bot is writing, and only syncs on checkpoints
+            _connection.execute("pragma journal_mode = WAL")
+            _connection.execute("pragma synchronous = NORMAL")
+            # negative cache_size is in KiB rather than pages
+            _connection.execute("pragma cache_size = -" + str(constants.db_cache_kb))
+            _connection.execute("pragma temp_store = MEMORY")
+        return _connection
+
+
+# schema migrations, applied in order. The database's user_version pragma records how many have already been applied,
+#  so existing piplanes.db files are upgraded in place and new ones get every step
+migrations = [
+    # 1: unique keys so "insert or ignore" actually ignores, plus indexes for the hot lookups
+    [
+        # clear out any duplicates that built up before the keys existed, keeping the first copy
+        "delete from aircraft where rowid not in (select min(rowid) from aircraft group by aircraft_key)",
+        "delete from aircraft_type_details where rowid not in "
+        "(select min(rowid) from aircraft_type_details group by aircraft_type)",
+        "delete from airline_details where rowid not in (select min(rowid) from airline_details group by airline_code)",
+        "delete from tail_owner where rowid not in (select min(rowid) from tail_owner group by ident)",
+        "create unique index if not exists aircraft_key_idx on aircraft (aircraft_key)",
+        # aircraft_exists() looks up the newest entry for an icao code
+        "create index if not exists aircraft_icao_time_idx on aircraft (icao_code, time_entered)",
+        # tweet() only ever wants the rows that haven't been sent, which is a tiny slice of the table
+        "create index if not exists aircraft_untweeted_idx on aircraft (time_entered) where tweet_status = 0",
+        "create unique index if not exists aircraft_type_details_idx on aircraft_type_details (aircraft_type)",
+        "create unique index if not exists airline_details_idx on airline_details (airline_code)",
+        "create unique index if not exists tail_owner_idx on tail_owner (ident)",
+    ],
+    # 2: persistent cache of FXML FlightInfoStatus responses, keyed by ident
+    [
+        "create table if not exists fxml_flightinfo_cache ("
+        "ident text primary key"
+        ", response text"
+        ", fetched integer"
+        ", expires integer"
+        ")",
+    ],
+    # 3: bitly links we've already shortened, so each FlightAware url only costs one bitly call
+    [
+        "create table if not exists short_links ("
+        "long_url text primary key"
+        ", short_url text"
+        ")",
+    ],
+    # 4: outbound API calls per calendar month, to keep an eye on the FXML quota
+    [
+        "create table if not exists api_usage ("
+        "month text"
+        ", endpoint text"
+        ", calls integer"
+        ", primary key (month, endpoint)"
+        ")",
+    ],
+    # 5: position history for each pass through our airspace, packed into one compressed blob per pass (see tracks.py)
+    [
+        "create table if not exists track ("
+        "aircraft_key text"
+        ", started integer"
+        ", ended integer"
+        ", points integer"
+        ", data blob"
+        ", primary key (aircraft_key, started)"
+        ")",
+    ],
+    # 6: aircraft entries keyed on icao code plus the epoch time they entered our airspace, with integer times
+    #  throughout. The old text layout (aircraft_key "hex$YYYY-mm-dd HH:MM:SS", formatted local times) lives on as the
+    #  read-only aircraft view, so existing queries against it keep working
+    [
+        "create table sightings ("
+        "icao_code text not null"
+        ", entered integer not null"
+        ", exited integer"
+        ", aircraft text"
+        ", tail_number text"
+        ", flight_number text"
+        ", desc text"
+        ", fa_url text"
+        ", speed real"
+        ", altitude integer"
+        ", heading integer"
+        ", squawk text"
+        ", tweet_status integer"
+        ", lat real"
+        ", lon real"
+        ", primary key (icao_code, entered)"
+        ")",
+        # the old times were formatted local time, which 'utc' converts back to epoch seconds
+        "insert or ignore into sightings select icao_code"
+        ", cast(strftime('%s', time_entered, 'utc') as integer)"
+        ", cast(strftime('%s', nullif(time_exited, ''), 'utc') as integer)"
+        ", aircraft, tail_number, flight_number, desc, fa_url, speed, altitude, heading, squawk, tweet_status, lat, lon"
+        " from aircraft where icao_code is not null and time_entered is not null order by rowid",
+        "drop table aircraft",
+        "create index sightings_entered_idx on sightings (entered)",
+        "create index sightings_untweeted_idx on sightings (entered) where tweet_status = 0",
+        "create view aircraft as select"
+        " icao_code || '$' || datetime(entered, 'unixepoch', 'localtime') as aircraft_key"
+        ", aircraft, tail_number, flight_number, desc, fa_url, speed, altitude, heading, icao_code, squawk"
+        ", tweet_status"
+        ", datetime(entered, 'unixepoch', 'localtime') as time_entered"
+        ", coalesce(datetime(exited, 'unixepoch', 'localtime'), '') as time_exited"
+        ", lat, lon"
+        " from sightings",
+        # tracks follow the new key
+        "create table track_by_sighting ("
+        "icao_code text"
+        ", entered integer"
+        ", started integer"
+        ", ended integer"
+        ", points integer"
+        ", data blob"
+        ", primary key (icao_code, entered, started)"
+        ")",
+        "insert or ignore into track_by_sighting select substr(aircraft_key, 1, instr(aircraft_key, '$') - 1)"
+        ", cast(strftime('%s', substr(aircraft_key, instr(aircraft_key, '$') + 1), 'utc') as integer)"
+        ", started, ended, points, data from track",
+        "drop table track",
+        "alter table track_by_sighting rename to track",
+    ],
+    # 7: traffic statistics, kept up to date as sightings are added (see traffic_stats.py)
+    [
+        "alter table sightings add column airline_code text",
+        # older rows never recorded the airline. Airline flight numbers are the ICAO airline code followed by digits
+        "update sightings set airline_code = substr(flight_number, 1, 3)"
+        " where flight_number glob '[A-Z][A-Z][A-Z][0-9]*' and desc not like 'Private%'",
+        # one count per dimension (total, hour, aircraft_type, airline, direction), local day and value
+        "create table traffic_stats ("
+        "dimension text"
+        ", day text"
+        ", value text"
+        ", sightings integer"
+        ", primary key (dimension, day, value)"
+        ") without rowid",
+        # days whose summary has already been tweeted
+        "create table summary_tweets ("
+        "day text primary key"
+        ", sent integer"
+        ")",
+    ],
+]
+
+
+def migrate():
+    conn = get_connection()
+    version = conn.execute("pragma user_version").fetchone()[0]
+    for number, statements in enumerate(migrations[version:], start=version + 1):
+        logger.info("Migrating database to schema version %d", number)
+        # run each step in its own transaction so a failure leaves the database at the previous version
+        conn.execute("begin")
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute("pragma user_version = " + str(number))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+
+def queue_write(statement, values):
+    with lock:
+        _pending_writes.append((statement, values))
+        # don't let the buffer grow without limit if flush() isn't being called for some reason
+        if _pending_writes.__len__() >= constants.db_max_pending_writes:
+            flush()
+
+
+def flush():
+    # also commits anything executed directly on the shared connection since the last commit
+    with lock:
+        return _flush()
+
+
+def _flush():
+    global _pending_writes
+    if _pending_writes.__len__() == 0 and not (_connection is not None and _connection.in_transaction):
+        return 0
+    writes = _pending_writes
+    _pending_writes = []
+    conn = get_connection()
+    committing = False
+    try:
+        # group runs of the same statement into executemany calls, keeping the overall order intact so an update
+        #  always lands after the insert it applies to
+        index = 0
+        while index < writes.__len__():
+            statement = writes[index][0]
+            batch = []
+            while index < writes.__len__() and writes[index][0] == statement:
+                batch.append(writes[index][1])
+                index += 1
+            conn.executemany(statement, batch)
+        committing = True
+        conn.commit()
+    except BaseException as e:
+        # any error, and also SIGTERM (SystemExit) or Ctrl-C landing part way through. Undo the partial batch and put
+        #  the writes back so they're retried on the next flush (or the one on the way out) rather than lost
+        #  no open transaction once we've got as far as committing means the commit went through, and putting the
+        #  writes back would apply them twice
+        if conn.in_transaction:
+            conn.rollback()
+            _pending_writes = writes + _pending_writes
+        elif not committing:
+            _pending_writes = writes + _pending_writes
+        if isinstance(e, sqlite3.Error):
+            logger.error("Error writing to database: %s", e)
+        raise
+    return writes.__len__()
+
+
+def close_connection():
+    global _connection
+    if _connection is not None:
+        # anything still buffered has to make it to disk before we go
+        try:
+            flush()
+        except sqlite3.Error as e:
+            logger.error("Unable to flush pending writes on shutdown: %s", e)
+        # fold the WAL back into the main database file so a plain copy of it is complete
+        try:
+            _connection.execute("pragma wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            logger.error("Error checkpointing database: %s", e)
+        _connection.close()
+        _connection = None
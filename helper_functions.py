@@ -1,809 +1,1093 @@
-import constants
-import geopy.distance
-import json
-import urllib.request
-import urllib.error
-import sqlite3
-import datetime
-import requests
-import twython
-import traceback
-import math
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from bitlyshortener import Shortener
-
-
-def get_distance(my_location, remote_location):
-    return geopy.distance.distance(my_location, remote_location).kilometers
-
-
-# shamelessly taken from https://gist.github.com/jeromer/2005586
-def get_bearing(pointA, pointB):
-    lat1 = math.radians(pointA[0])
-    lat2 = math.radians(pointB[0])
-
-    diffLong = math.radians(pointB[1] - pointA[1])
-
-    x = math.sin(diffLong) * math.cos(lat2)
-    y = math.cos(lat1) * math.sin(lat2) - (math.sin(lat1)
-                                           * math.cos(lat2) * math.cos(diffLong))
-
-    initial_bearing = math.atan2(x, y)
-
-    # Now we have the initial bearing but math.atan2 return values
-    # from -180° to + 180° which is not what we want for a compass bearing
-    # The solution is to normalize the initial bearing as shown below
-    initial_bearing = math.degrees(initial_bearing)
-    compass_bearing = (initial_bearing + 360) % 360
-
-    return compass_bearing
-
-
-def speed_to_kph(speed):
-    return speed * constants.knots_to_kph
-
-
-def dt_to_datetime(dt):
-    return datetime.datetime.fromtimestamp(int(dt)).strftime('%Y-%m-%d %H:%M:%S')
-
-
-def datetime_to_dt(formatted_datetime):
-    return int(datetime.datetime.strptime(formatted_datetime, '%Y-%m-%d %H:%M:%S').timestamp())
-
-
-def heading_to_direction(heading):
-    if heading > 348.75 or heading < 11.25:
-        return "N"
-    elif heading >= 11.25 and heading < 33.75:
-        return "NNE"
-    elif heading >= 33.75 and heading < 56.25:
-        return "NE"
-    elif heading >= 56.25 and heading < 78.75:
-        return "ENE"
-    elif heading >= 78.75 and heading < 101.25:
-        return "E"
-    elif heading >= 101.25 and heading < 123.75:
-        return "ESE"
-    elif heading >= 123.75 and heading < 146.25:
-        return "SE"
-    elif heading >= 146.25 and heading < 168.75:
-        return "SSE"
-    elif heading >= 168.75 and heading < 191.25:
-        return "S"
-    elif heading >= 191.25 and heading < 213.75:
-        return "SSW"
-    elif heading >= 213.75 and heading < 236.25:
-        return "SW"
-    elif heading >= 236.25 and heading < 258.75:
-        return "WSW"
-    elif heading >= 258.75 and heading < 281.25:
-        return "W"
-    elif heading >= 281.25 and heading < 303.75:
-        return "WNW"
-    elif heading >= 303.75 and heading < 326.25:
-        return "NW"
-    else:  # heading >= 326.25 and heading < 348.75
-        return "NNW"
-
-
-def check_current_weather():
-    # grab the most recent entry in the weather cache database
-    weather_query = "select * from weather order by datetime desc limit 1"
-    conn = sqlite3.connect(constants.db_name)
-    cur = conn.cursor()
-    cur.execute(weather_query)
-    newest_weather = cur.fetchone()
-
-    # check to see if this weather info is stale, or even exists at all
-    if (newest_weather is None) or \
-                            newest_weather[0] + constants.weather_interval < \
-                    datetime_to_dt(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')):
-        print("Weather info is considered stale")
-        # also check when we last queried the API. Only a finite number allowed daily so throttling is a must
-        if (newest_weather is not None) and newest_weather[8] + constants.weather_api_check_frequency < \
-                datetime_to_dt(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')):
-            # it's been more than <weather_api_check_frequency> seconds, query the API again
-            print("querying info from OWM API and attempting to update database")
-
-            # make the web request to pull the json data
-            req = urllib.request.Request(constants.OWM_URL)
-            try:
-                data = json.loads(urllib.request.urlopen(req).read().decode('utf-8'))
-            except urllib.error.HTTPError as e:
-                print("HTTP Error: " + e.reason)
-                data = None
-            except urllib.error.URLError as e:
-                print("OWM URL Error: " + e.reason.strerror + "\nCheck network connections")
-                data = None
-            except Exception as e:
-                print("Error reaching " + constants.OWM_URL)
-                print(str(e))
-                print(traceback.format_exc())
-                data = None
-            if data is not None:
-                weather_insert = "insert or replace into weather values (?,?,?,?,?,?,?,?,?);"
-                # visibility is a calculated value and OWM may not always return it. We must handle this scenario
-                if 'visibility' in data:
-                    vis = data['visibility']
-                else:
-                    vis = -1
-                weather_values = [data['dt'],
-                                  data['coord']['lat'],
-                                  data['coord']['lon'],
-                                  data['weather'][0]['description'],
-                                  data['main']['temp'],
-                                  data['main']['pressure'],
-                                  data['main']['humidity'],
-                                  vis,
-                                  datetime_to_dt(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-                                  ]
-
-                print("Updating database entry with timestamp of " + str(
-                    datetime_to_dt(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))))
-                cur.execute(weather_insert, weather_values)
-                conn.commit()
-
-                weather = {"visibility": vis * constants.meters_to_feet,
-                           "desc": data['weather'][0]['description'],
-                           "timestamp": dt_to_datetime(data['dt'])}
-            else:
-                print("Error accessing OWM API. Returning cached weather values")
-                weather = {"visibility": int(newest_weather[7] * constants.meters_to_feet),
-                           "desc": newest_weather[3],
-                           "timestamp": dt_to_datetime(newest_weather[0])
-                           }
-        else:
-            # don't bother checking the API, just return the current info
-            print("OWM API was recently queried. Waiting before checking again. Returning cached weather values")
-            weather = {"visibility": int(newest_weather[7] * constants.meters_to_feet),
-                       "desc": newest_weather[3],
-                       "timestamp": dt_to_datetime(newest_weather[0])
-                       }
-    else:
-        weather = {"visibility": int(newest_weather[7] * constants.meters_to_feet),
-                   "desc": newest_weather[3],
-                   "timestamp": dt_to_datetime(newest_weather[0])
-                   }
-        print("Got weather info from cache")
-
-    cur.close()
-    conn.close()
-
-    return weather
-
-
-def create_sql_tables():
-    weather_table = "Create table if not exists weather (" \
-                    "datetime integer UNIQUE" \
-                    ", lat real" \
-                    ", long real" \
-                    ", desc text" \
-                    ", temp real" \
-                    ", pressure integer" \
-                    ", humidity integer" \
-                    ", visibility integer" \
-                    ", lastchecked integer" \
-                    ")"
-
-    aircraft_table = "Create table if not exists aircraft (" \
-                     "aircraft_key text" \
-                     ", aircraft text" \
-                     ", tail_number text" \
-                     ", flight_number text" \
-                     ", desc text" \
-                     ", fa_url text" \
-                     ", speed real" \
-                     ", altitude integer" \
-                     ", heading integer" \
-                     ", icao_code text" \
-                     ", squawk text" \
-                     ", tweet_status integer" \
-                     ", time_entered text" \
-                     ", time_exited text" \
-                     ", lat real" \
-                     ", lon real" \
-                     ")"
-    aircraft_details_table = "Create table if not exists aircraft_type_details (" \
-                             "aircraft_type text" \
-                             ", description text" \
-                             ", engine_count integer" \
-                             ", engine_type text" \
-                             ", manufacturer text" \
-                             ", type text" \
-                             ")"
-
-    airline_details_table = "Create table if not exists airline_details (" \
-                            "airline_code text" \
-                            ", callsign text" \
-                            ", country text" \
-                            ", location text" \
-                            ", name text" \
-                            ", phone text" \
-                            ", shortname text" \
-                            ", url text" \
-                            ")"
-
-    tail_owner_table = "Create table if not exists tail_owner (" \
-                            "ident text" \
-                            ", location text" \
-                            ", location2 text" \
-                            ", owner text" \
-                            ", website text" \
-                            ")"
-
-    # connect to the database
-    conn = sqlite3.connect(constants.db_name)
-
-    # get the cursor so we can do stuff
-    cur = conn.cursor()
-
-    # create our tables
-    cur.execute(weather_table)
-    conn.commit()
-    cur.execute(aircraft_table)
-    conn.commit()
-    cur.execute(aircraft_details_table)
-    conn.commit()
-    cur.execute(airline_details_table)
-    conn.commit()
-    cur.execute(tail_owner_table)
-    conn.commit()
-
-    # close the connections
-    cur.close()
-    conn.close()
-
-
-def aircraft_exists(icao, squawk):
-    # find the most recent entry for this aircraft
-    query = "select * from aircraft where icao_code = (?) order by time_entered desc limit 1"
-    # connect to the database
-    conn = sqlite3.connect(constants.db_name)
-    # get the cursor so we can do stuff
-    cur = conn.cursor()
-    cur.execute(query, [icao])
-
-    # run the query to see if this one is entered yet
-    this_aircraft = cur.fetchone()
-    if this_aircraft is None:
-        # this aircraft has never been in our airspace
-        cur.close()
-        conn.close()
-        return False
-    else:
-        # we've seen this before, if it was in the last few minutes we should ignore it
-        recent_timestamp = this_aircraft[0].split("$")[1]
-        recent_squawk = this_aircraft[10]
-        # if the newest entry in the database is older than X seconds ago, we know it's a new flight
-        if (datetime_to_dt(recent_timestamp) + constants.squawk_delay < datetime_to_dt(
-                datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))):
-            cur.close()
-            conn.close()
-            return False
-        # if this squawk is the same as the previous one, this is already recorded
-        elif recent_squawk == squawk:
-            cur.close()
-            conn.close()
-            return True
-        # if this is just a case of the aircraft turning off it's squawk code we should ignore it. Not a new entry
-        elif recent_squawk != 'none' and squawk == 'none':
-            cur.close()
-            conn.close()
-            return True
-        # if this aircraft had no squawk and now does, let's update that but not record it as a new entry
-        elif recent_squawk == 'none' and squawk != 'none':
-            # send the update query to SQL
-            update_aircraft_query = "update aircraft set squawk = (?) where aircraft_key = (?)"
-            update_aircraft_values = [squawk, this_aircraft[0]]
-            cur.execute(update_aircraft_query, update_aircraft_values)
-            conn.commit()
-            cur.close()
-            conn.close()
-            print(icao + ": set squawk value to " + squawk)
-            return True
-        # Last possible case is if the squawk code changed to a different valid value. Already cataloged.
-        else:
-            cur.close()
-            conn.close()
-            return True
-
-
-def check_if_known(airplane, aircraft_db):
-    url = "https://flightaware.com/live/modes/" + airplane['hex'] + "/redirect"
-    try:
-        redirect_url = urllib.request.urlopen(urllib.request.Request(url)).geturl()
-    except urllib.error.HTTPError as e:
-        print("HTTP Error: " + e.reason)
-        return None
-    except urllib.error.URLError as e:
-        print("FlightAware URL Error: " + e.reason.strerror + "\nCheck network connections")
-        return None
-    except Exception as e:
-        print("Error accessing flightaware.com. Unable to check aircraft")
-        print(str(e))
-        print(traceback.format_exc())
-        return None
-
-    known_info = {'fl_num': 'x', 'redirect_url': 'y'}
-    # if the redirect gave us the flight details enter it
-    if url != redirect_url:
-        known_info['fl_num'] = redirect_url.split('/')[5]
-        known_info['redirect_url'] = redirect_url
-    # or possibly the flight number info is being sent by the aircraft itself
-    elif 'flight' in airplane:
-        known_info['fl_num'] = airplane['flight'].replace(' ', '')
-        known_info['redirect_url'] = "https://flightaware.com/live/flight/" + known_info['fl_num']
-    # next we can try to look up using the local FR24 aircraft DB if it's available
-    elif aircraft_db is not None:
-        # here we will check the csv file database file
-        try:
-            if '~' in airplane['hex']:
-                airplane_hex = airplane['hex'][1:]
-            else:
-                airplane_hex = airplane['hex']
-            # fancy way of finding the row in the DF with the hex code, and getting the ident string
-            ident = aircraft_db.loc[aircraft_db['icao'] == airplane_hex]['regid'].values[0].replace(' ', '').replace('-', '').upper()
-            # tail number != flight number but the URLs load the same page info, and return the same API data
-            known_info['fl_num'] = ident
-            known_info['redirect_url'] = "https://flightaware.com/live/flight/" + ident
-            print(airplane_hex + ": Flight info retrieved from local FR24 db (Tail #" + ident + ")")
-        except Exception as e:
-            print("ICAO hex code " + airplane['hex'] + " missing from local FR24 db. No details available.")
-            known_info = None
-    else:
-        known_info = None
-
-    return known_info
-
-
-def get_flight_info(airplane, aircraft_db):
-    aircraft_type = None
-
-    deets = check_if_known(airplane, aircraft_db)
-
-    # If Flight Aware doesn't have detail on a specific flight we can't get any good details
-    if deets is None:
-        print(airplane['hex'] + ": flight unknown to FlightAware")
-        flight_info = None
-        no_details = True
-
-    else:
-        no_details = False
-
-        # from the flight number we can get much more detail from the FA API
-        payload = {'ident': deets['fl_num'], 'howMany': constants.fxml_flightinfo_limit}
-        api_error = False
-        try:
-            response = requests.get(constants.fxmlUrl + "FlightInfoStatus", params=payload,
-                                    auth=(constants.fa_username, constants.fxml_key))
-        except requests.exceptions.RequestException as e:
-            print("Error accessing FXML API")
-            api_error = True
-
-        if response.status_code == 200 and api_error == False:
-            flight_data = response.json()
-            # the flight data will contain up to 15 cataloged flights for this flight number. We only want
-            #  the current in-progress flight
-            if 'FlightInfoStatusResult' in flight_data:
-                for flight in flight_data['FlightInfoStatusResult']['flights']:
-                    # there is an edge case here where all flights are inactive. Consider this an 'unknown flight'
-                    if 0 <= flight['progress_percent'] < 100:
-                        if 'full_aircrafttype' in flight:
-                            aircraft_type = flight['full_aircrafttype']
-                        elif 'aircrafttype' in flight:
-                            aircraft_type = flight['aircrafttype']
-                        else:
-                            aircraft_type = "Unknown"
-                        if 'airline' in flight:
-                            airline = get_airline_info(flight['airline'])
-                            if 'airline_iata' in flight:
-                                iata = flight['airline_iata']
-                            else:
-                                iata = flight['airline']
-                            origin = flight['origin']['airport_name']
-                            destination = flight['destination']['airport_name']
-                            flight_num = flight['flightnumber']
-                        else:
-                            airline = "Private Flight"
-                            iata = "n/a"
-                            flight_num = deets['fl_num']
-                        if flight['origin']['airport_name'] == '':
-                            origin = flight['origin']['code']
-                        else:
-                            origin = flight['origin']['airport_name']
-                        if flight['destination']['airport_name'] == '':
-                            destination = flight['destination']['code']
-                        else:
-                            destination = flight['destination']['airport_name']
-                        flight_desc = airline + " (" + iata + ") #" + flight_num + " from " + origin + " to " + \
-                                      destination
-                        fa_url = deets['redirect_url']
-                        if 'tailnumber' in flight:
-                            tail_number = flight['tailnumber']
-                        else:
-                            tail_number = flight_num
-                        break
-                # possible that no flights show as active. FXML would not be returning accurate data if so.
-                if aircraft_type is None:
-                    print(airplane['hex'] + ": no active flights found")
-                    flight_desc = "unknown flight"
-                    fa_url = "unknown flight"
-                    tail_number = deets['fl_num']
-            else:
-                print(airplane['hex'] + ": this aircraft has requested to not be tracked")
-                #check if we have owner information for this tail number yet
-                query = "select * from tail_owner where ident = (?) limit 1"
-                # connect to the database
-                conn = sqlite3.connect(constants.db_name)
-                # get the cursor so we can do stuff
-                cur = conn.cursor()
-                cur.execute(query, [deets['fl_num']])
-
-                # run the query to see if this one is entered yet
-                this_ident = cur.fetchone()
-                if this_ident is not None:
-                    # set the flight info based on what the table says
-                    flight_desc = "Private flight: " + deets['fl_num'] + " - is unavailable for public tracking\n" + \
-                                  "Owner: " + this_ident[3] + " (" + this_ident[1] + ")"
-                    cur.close()
-                    conn.close()
-                    print(deets['fl_num'] + " found in Tail Owners table. No need to query FXML API")
-                else:
-                    # this aircraft has never been in our airspace, check the API
-                    payload = {'ident': deets['fl_num']}
-                    # no error checking here. Bold assumption that if the API call above worked, this one will too
-                    response = requests.get(constants.fxmlUrl + "TailOwner", params=payload,
-                                            auth=(constants.fa_username, constants.fxml_key))
-                    aircraft_data = response.json()
-                    flight_desc = "Private flight: " + deets['fl_num'] + " - is unavailable for public tracking\n" + \
-                                  "Owner: " + aircraft_data['TailOwnerResult']['owner'].replace('&quot;', '"') + " (" + \
-                                  aircraft_data['TailOwnerResult']['location'] + ")"
-                    # we must also update the tail_owner table so next time the API doesn't need to be queried
-                    tail_insert = "insert or ignore into tail_owner values (?,?,?,?,?);"
-                    tail_values = [deets['fl_num'],
-                                   aircraft_data['TailOwnerResult']['location'],
-                                   aircraft_data['TailOwnerResult']['location2'],
-                                   aircraft_data['TailOwnerResult']['owner'].replace('&quot;', '"'),
-                                   aircraft_data['TailOwnerResult']['website']
-                                   ]
-                    cur.execute(tail_insert, tail_values)
-                    conn.commit()
-                    cur.close()
-                    conn.close()
-                    print(deets['fl_num'] + " added to Tail Owners table")
-
-                aircraft_type = "Unknown"
-                fa_url = "private flight"
-                tail_number = deets['fl_num']
-
-            # now we can start building the dict
-            if aircraft_type is None:
-                print("wait")
-            flight_info = {"aircraft": aircraft_type,
-                           "flight_number": deets['fl_num'],
-                           "desc": flight_desc,
-                           "fa_url": fa_url,
-                           "tail_number": tail_number
-                           }
-        else:
-            print(airplane['hex'] + ": Error retrieving data upstream")
-            flight_info = None
-
-    if no_details:
-        flight_info = "ignore me"
-    else:
-        # pull out the squawk code
-        if 'squawk' in airplane:
-            squawk = airplane['squawk']
-        else:
-            squawk = "none"
-
-        if 'gs' in airplane:
-            speed = round(speed_to_kph(airplane['gs']), 2)
-        else:
-            speed = 0
-        if 'track' in airplane:
-            track = airplane['track']
-        else:
-            track = 0
-
-        if flight_info is not None:
-            # fill the dict with all other relevant values, direct from the aircraft itself
-            flight_info['aircraft_key'] = create_aircraft_key(airplane['hex'], squawk)
-            flight_info['speed'] = speed
-            if 'alt_baro' in airplane:
-                flight_info['altitude'] = airplane['alt_baro']
-            else:
-                flight_info['altitude'] = 0
-            flight_info['heading'] = track
-            flight_info['icao_code'] = airplane['hex']
-            flight_info['squawk'] = squawk
-            flight_info['tweet_status'] = 0
-            flight_info['time_entered'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            flight_info['time_exited'] = ''
-            flight_info['lat'] = airplane['lat']
-            flight_info['lon'] = airplane['lon']
-
-        else:
-            # there's not much data available for this one. grab in what we can
-            if 'gs' in airplane:
-                speed = round(speed_to_kph(airplane['gs']), 2)
-            else:
-                speed = 0
-            if 'alt_baro' in airplane:
-                alt = airplane['alt_baro']
-            else:
-                alt = 0
-            if 'heading' in airplane:
-                head = airplane['track']
-            else:
-                head = 0
-            flight_info = {"aircraft_key": create_aircraft_key(airplane['hex'], squawk),
-                           "aircraft": 'none',
-                           "tail_number": 'none',
-                           "flight_number": 'none',
-                           "desc": 'none',
-                           "fa_url": 'none',
-                           "speed": speed,
-                           "altitude": alt,
-                           "heading": head,
-                           "icao_code": airplane['hex'],
-                           "squawk": squawk,
-                           "tweet_status": 0,
-                           "time_entered": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                           "time_exited": '',
-                           "lat": airplane['lat'],
-                           "lon": airplane['lon']
-                           }
-
-    return flight_info
-
-
-def commit_flight_info(flight_dict):
-    key = create_aircraft_key(flight_dict['icao_code'], flight_dict['squawk'])
-
-    conn = sqlite3.connect(constants.db_name)
-    cur = conn.cursor()
-    aircraft_insert = "insert or ignore into aircraft values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?);"
-    # (aircraft_key, aircraft, tail_number, flight_number, desc, fa_url, speed, altitude. heading, icao_code, squawk, tweet_status, lat, lon)
-    aircraft_values = [flight_dict['aircraft_key'],
-                       flight_dict['aircraft'],
-                       flight_dict['tail_number'],
-                       flight_dict['flight_number'],
-                       flight_dict['desc'],
-                       flight_dict['fa_url'],
-                       flight_dict['speed'],
-                       flight_dict['altitude'],
-                       flight_dict['heading'],
-                       flight_dict['icao_code'],
-                       flight_dict['squawk'],
-                       flight_dict['tweet_status'],
-                       flight_dict['time_entered'],
-                       flight_dict['time_exited'],
-                       flight_dict['lat'],
-                       flight_dict['lon']
-                       ]
-
-    cur.execute(aircraft_insert, aircraft_values)
-    conn.commit()
-    print(flight_dict['icao_code'] + ": written to aircraft table")
-
-    # also find out more details about the type of aircraft
-    # TODO must deal with the edge case where this is NoneType. Check icao c036d2 from flightinfostatus API
-    if flight_dict['aircraft'] != "none" and flight_dict['aircraft'] != "Unknown":
-        if flight_dict['aircraft'] is None:
-            print("problem")
-        else:
-            get_aircraft_info(flight_dict['aircraft'])
-
-    # close the connections
-    cur.close()
-    conn.close()
-
-
-def create_aircraft_key(icao, squawk):
-    return icao + "$" + datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-
-def get_aircraft_info(aircraft_type):
-    # check the database first
-    query = "select * from aircraft_type_details where aircraft_type = (?)"
-    # connect to the database
-    conn = sqlite3.connect(constants.db_name)
-    # get the cursor so we can do stuff
-    cur = conn.cursor()
-    cur.execute(query, [aircraft_type])
-    # run the query to see if this one is written yet
-    this_aircraft = cur.fetchone()
-
-    if this_aircraft is None:
-        print("No details for " + aircraft_type + ". Querying FlightXML")
-        payload = {'type': aircraft_type}
-        api_error = False
-        try:
-            response = requests.get(constants.fxmlUrl + "AircraftType", params=payload,
-                                    auth=(constants.fa_username, constants.fxml_key))
-        except requests.exceptions.RequestException as e:
-            api_error = True
-        if response.status_code == 200 and api_error == False and 'AircraftTypeResult' in response.json():
-            data = response.json()
-            # parse this out and write to the database
-            aircraft_type_insert = "insert or ignore into aircraft_type_details values (?,?,?,?,?,?);"
-            # aircraft_type text, description text, engine_count integer, engine_type text, manufacturer text
-            aircraft_type_values = [aircraft_type,
-                                    data['AircraftTypeResult']['description'],
-                                    data['AircraftTypeResult']['engine_count'],
-                                    data['AircraftTypeResult']['engine_type'],
-                                    data['AircraftTypeResult']['manufacturer'],
-                                    data['AircraftTypeResult']['type']
-                                    ]
-            cur.execute(aircraft_type_insert, aircraft_type_values)
-            conn.commit()
-            print(aircraft_type + ": written to aircraft_type_details table")
-
-        else:
-            print("Error accessing FlightXML. No details for " + aircraft_type)
-
-    else:
-        print("Aircraft type details exist for " + aircraft_type + ". No need to query FXML API")
-
-    cur.close()
-    conn.close()
-
-
-def tweet(weather):
-    query = "select * from aircraft where tweet_status = 0 and aircraft is not null and aircraft != 'none' order by time_entered asc"
-    conn = sqlite3.connect(constants.db_name)
-    # get the cursor so we can do stuff
-    cur = conn.cursor()
-    cur.execute(query)
-    # run the query to see if this one is entered yet
-    aircrafts_to_tweet = cur.fetchall()
-
-    twitter = twython.Twython(constants.twitter_app_key, constants.twitter_app_secret,
-                              constants.twitter_token, constants.twitter_token_secret)
-
-    for aircraft in aircrafts_to_tweet:
-        direction = heading_to_direction(get_bearing(constants.home, (aircraft[14], aircraft[15])))
-        message = "Incoming from the " + direction + "!\n"
-        # flight description
-        message += aircraft[4] + "\n"  # desc
-        # aircraft type
-        if aircraft[1] == "Unknown":  # aircraft type (ex. B737 or A320)
-            message += "Aircraft type: unavailable\n"
-        else:
-            message += "Flight # " + aircraft[3] + "\n"
-            # look up the plane details in the other DB table
-            query = "select * from aircraft_type_details where aircraft_type = (?)"
-            cur.execute(query, [aircraft[1]])
-            details = cur.fetchone()
-            if details is None:
-                message += "Aircraft: Unknown \n"
-            else:
-                message += "Aircraft: " + details[4] + " " + details[5] + "\n"
-        # FA url
-        if aircraft[5].__contains__("https"):
-            link = shorten_link(aircraft[5])
-            if link is not None:
-                message += "Details: " + link + "\n"
-        # additional nice to know details
-        message += "Tail # " + aircraft[2] + "\n"
-        message += "Speed: " + str(int(aircraft[6])) + " km/hr heading " + heading_to_direction(aircraft[8]) + "\n"
-        message += "Alt: " + str(aircraft[7]) + " ft\n"
-        message += "Weather: " + weather['desc'] + "\n"
-        # message += "Ceiling: " + str(weather['visibility']) + " ft\n" # this value doesn't seem accurate
-        # TODO check other weather APIs, or if there's a better measure available from OWM
-
-        message += constants.hashtags + "\n"
-
-        print("Tweet character count: " + str(message.__len__()))
-        # super ugly temp fix. tweet should be split into 2 messages.
-        if message.__len__() > 278:
-            message = message[:277]
-        result = None
-        try:
-            result = twitter.update_status(status=message)
-        except Exception as e:
-            print("Error tweeting: " + str(e))
-            email_problem(str(e))
-        if result is not None:
-            # now lets set the tweet_status for this aircraft to 1 so it won't be sent out again
-            update_query = "update aircraft set tweet_status = 1 where aircraft_key = (?)"
-            cur.execute(update_query, [aircraft[0]])
-            conn.commit()
-            print(aircraft[9] + ": tweet sent. Status updated in database")
-
-def get_airline_info(airline_code):
-    # check the database first
-    query = "select * from airline_details where airline_code = (?)"
-    # connect to the database
-    conn = sqlite3.connect(constants.db_name)
-    # get the cursor so we can do stuff
-    cur = conn.cursor()
-    cur.execute(query, [airline_code])
-    # run the query to see if this one is written yet
-    this_airline = cur.fetchone()
-
-    if this_airline is None:
-        print("No details for " + airline_code + ". Querying FlightXML")
-        payload = {'airline_code': airline_code}
-        api_error = False
-        try:
-            response = requests.get(constants.fxmlUrl + "AirlineInfo", params=payload,
-                                    auth=(constants.fa_username, constants.fxml_key))
-        except requests.exceptions.RequestException as e:
-            api_error = True
-        if response.status_code == 200 and api_error == False and 'AirlineInfoResult' in response.json():
-            data = response.json()
-            # parse this out and write to the database
-            airline_insert = "insert or ignore into airline_details values (?,?,?,?,?,?,?,?);"
-            # aircraft_type text, description text, engine_count integer, engine_type text, manufacturer text
-            airline_values = [airline_code,
-                              data['AirlineInfoResult']['callsign'],
-                              data['AirlineInfoResult']['country'],
-                              data['AirlineInfoResult']['location'],
-                              data['AirlineInfoResult']['name'],
-                              data['AirlineInfoResult']['phone'],
-                              data['AirlineInfoResult']['shortname'],
-                              data['AirlineInfoResult']['url']
-                              ]
-            cur.execute(airline_insert, airline_values)
-            conn.commit()
-            print(airline_code + ": written to airline_details table")
-            # ideally we use the shortname for an airline. Use the full name if no shortname exists
-            if data['AirlineInfoResult']['shortname'] == '':
-                airline_name = data['AirlineInfoResult']['name']
-            else:
-                airline_name = data['AirlineInfoResult']['shortname']
-
-        else:
-            print("Error accessing FlightXML. No details for " + airline_code)
-            airline_name = airline_code
-
-    else:
-        print("Airline details exist for " + airline_code + ". No need to query FXML API")
-        if this_airline[6] == '':
-            airline_name = this_airline[4]
-        else:
-            airline_name = this_airline[6]
-
-    cur.close()
-    conn.close()
-    return airline_name
-
-
-def shorten_link(url):
-    shortener = Shortener(tokens=[constants.bitly_token])
-    short_link = shortener.shorten_urls([url])
-    if short_link is not None:
-        return short_link[0]
-    else:
-        return None
-
-def email_problem(exception_reason):
-    
-    #build the message object
-    msg = MIMEMultipart('alternative')
-    msg['Subject'] = constants.subject
-    msg['From'] = constants.send_from
-    msg['To'] = constants.send_to
-
-    text = "No plain text option available. Use an HTML email client."
-    html = str(exception_reason)
-
-    # Record the MIME types of both parts - text/plain and text/html.
-    part1 = MIMEText(text, 'plain')
-    part2 = MIMEText(html, 'html')
-
-    #Attach parts into message container. According to RFC 2046, the last part of a multipart message, in this case
-    # the HTML message, is best and preferred.
-    msg.attach(part1)
-    msg.attach(part2)
-    
-    #now connect and send the email out
-    server = smtplib.SMTP(constants.smtp_server, constants.smtp_port)
-    server.ehlo()
-    server.sendmail(constants.send_from, constants.send_to, msg.as_string())
+import constants
+import database
+import http_client
+import sessions
+import tweet_dispatcher
+import metrics
+import weather
+import traffic_stats
+import sqlite3
+import datetime
+import time
+import requests
+import math
+import concurrent.futures
+import urllib.parse
+import threading
+import numpy
+import logging
+
+# geopy, twython, bitlyshortener and the email modules are imported inside the functions that use them. They're
+#  slow to load on a Pi and often aren't needed for a while after startup (or at all), so there's no point making
+#  every restart wait for them. numpy and requests are needed for the very first poll so they load up front
+
+logger = logging.getLogger("helper_functions")
+
+# worker threads for looking up newly seen aircraft. Created on first use
+enrichment_pool = None
+
+# aircraft projected to enter our airspace soon, whose lookups were started early. ICAO hex code ->
+#  {'future': enrichment future, 'expires': time.monotonic() after which we stop waiting for it to arrive}
+prefetched = {}
+
+# ICAO hex codes that FlightAware (and the local FR24 db) couldn't resolve, mapped to when we can try them again
+#  stops the same unknown aircraft from costing a redirect request on every poll while it's in range
+unknown_aircraft = {}
+
+# (kind, code) -> lock, so concurrent enrichment workers don't look up the same airline or aircraft type twice
+_lookup_locks = {}
+_lookup_locks_lock = threading.Lock()
+
+# long lived API clients, created on first use
+twitter_client = None
+link_shortener = None
+# long url -> bitly url. Backed by the short_links table so it survives restarts
+short_links = {}
+
+
+def get_distance(my_location, remote_location):
+    import geopy.distance
+    return geopy.distance.distance(my_location, remote_location).kilometers
+
+
+def filter_airspace(aircraft_list):
+    # batch version of get_distance/get_bearing for a whole aircraft.json snapshot. Returns only the aircraft inside
+    #  our airspace, with 'distance' (km) and 'bearing' (degrees from home) added to each dict
+    located = [airplane for airplane in aircraft_list if 'lat' in airplane and 'lon' in airplane]
+    if located.__len__() == 0:
+        return []
+
+    lats = numpy.array([airplane['lat'] for airplane in located], dtype=float)
+    lons = numpy.array([airplane['lon'] for airplane in located], dtype=float)
+
+    # cheap bounding box reject first. One degree of latitude is ~111km, longitude shrinks with cos(latitude)
+    #  pad the box slightly so the haversine/geodesic check below makes the final call
+    lat_span = constants.airspace_radius_km / 110.5
+    lon_span = constants.airspace_radius_km / (111.5 * max(math.cos(math.radians(constants.my_lat)), 0.01))
+    in_box = (numpy.abs(lats - constants.my_lat) <= lat_span * 1.01) & \
+             (numpy.abs((lons - constants.my_lon + 180) % 360 - 180) <= lon_span * 1.01)
+    candidates = numpy.nonzero(in_box)[0]
+    if candidates.__len__() == 0:
+        return []
+
+    distances = get_distances(constants.home, lats[candidates], lons[candidates])
+    bearings = get_bearings(constants.home, lats[candidates], lons[candidates])
+
+    in_range = []
+    edge_margin = constants.airspace_radius_km * constants.geodesic_refine_margin
+    for index, distance, bearing in zip(candidates, distances, bearings):
+        airplane = located[index]
+        # haversine can be off by up to ~0.56% vs the ellipsoid (north-south lines near the equator). Only pay for the
+        #  exact geodesic solve near the edge
+        if abs(distance - constants.airspace_radius_km) <= edge_margin:
+            distance = get_distance(constants.home, (airplane['lat'], airplane['lon']))
+        if distance <= constants.airspace_radius_km:
+            airplane['distance'] = float(distance)
+            airplane['bearing'] = float(bearing)
+            in_range.append(airplane)
+
+    return in_range
+
+
+# shamelessly taken from https://gist.github.com/jeromer/2005586
+def get_bearing(pointA, pointB):
+    lat1 = math.radians(pointA[0])
+    lat2 = math.radians(pointB[0])
+
+    diffLong = math.radians(pointB[1] - pointA[1])
+
+    x = math.sin(diffLong) * math.cos(lat2)
+    y = math.cos(lat1) * math.sin(lat2) - (math.sin(lat1)
+                                           * math.cos(lat2) * math.cos(diffLong))
+
+    initial_bearing = math.atan2(x, y)
+
+    # Now we have the initial bearing but math.atan2 return values
+    # from -180° to + 180° which is not what we want for a compass bearing
+    # The solution is to normalize the initial bearing as shown below
+    initial_bearing = math.degrees(initial_bearing)
+    compass_bearing = (initial_bearing + 360) % 360
+
+    return compass_bearing
+
+
+def get_distances(point, lats, lons):
+    # vectorized haversine (km) on the mean earth radius, for a whole numpy array of positions at once
+    lat1 = math.radians(point[0])
+    lat2 = numpy.radians(lats)
+    diff_lat = lat2 - lat1
+    diff_lon = numpy.radians(lons - point[1])
+
+    a = numpy.sin(diff_lat / 2) ** 2 + math.cos(lat1) * numpy.cos(lat2) * numpy.sin(diff_lon / 2) ** 2
+    return 2 * constants.earth_radius_km * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+def changed_aircraft(aircraft_list, last_positions):
+    # only the aircraft whose position has changed since the last snapshot. Everything else was already dealt with
+    #  last time round. last_positions (hex -> (lat, lon)) is updated in place
+    changed = []
+    current = {}
+    for airplane in aircraft_list:
+        if 'lat' not in airplane or 'lon' not in airplane:
+            continue
+        position = (airplane['lat'], airplane['lon'])
+        current[airplane['hex']] = position
+        if last_positions.get(airplane['hex']) != position:
+            changed.append(airplane)
+    # drop anything that's fallen out of the feed
+    last_positions.clear()
+    last_positions.update(current)
+    return changed
+
+
+def next_poll_interval(aircraft_list):
+    # poll quickly while aircraft are just outside the edge of our airspace so we catch them as they cross it, and
+    #  back off when there's nothing anywhere near us
+    located = [airplane for airplane in aircraft_list if 'lat' in airplane and 'lon' in airplane]
+    if located.__len__() == 0:
+        return constants.poll_interval_max
+    distances = get_distances(constants.home,
+                              numpy.array([airplane['lat'] for airplane in located], dtype=float),
+                              numpy.array([airplane['lon'] for airplane in located], dtype=float))
+    edge = constants.airspace_radius_km
+    if numpy.any((distances > edge) & (distances <= edge + constants.airspace_edge_band_km)):
+        return constants.poll_interval_min
+    if not numpy.any(distances <= edge + constants.airspace_quiet_band_km):
+        return constants.poll_interval_max
+    return constants.sleep_time
+
+
+def predict_entering(aircraft_list, horizon=None):
+    # aircraft outside our airspace whose current ground speed and track will bring them inside it within horizon
+    #  seconds. Positions are projected in a flat km grid centred on home, which is plenty accurate at these ranges
+    if horizon is None:
+        horizon = constants.prefetch_horizon
+    moving = [airplane for airplane in aircraft_list
+              if 'lat' in airplane and 'lon' in airplane and airplane.get('gs') and 'track' in airplane]
+    if moving.__len__() == 0 or horizon <= 0:
+        return []
+    lats = numpy.array([airplane['lat'] for airplane in moving], dtype=float)
+    lons = numpy.array([airplane['lon'] for airplane in moving], dtype=float)
+    tracks = numpy.radians(numpy.array([airplane['track'] for airplane in moving], dtype=float))
+    speeds = numpy.array([airplane['gs'] for airplane in moving], dtype=float) * constants.knots_to_kph / 3600
+
+    x = constants.earth_radius_km * numpy.radians((lons - constants.my_lon + 180) % 360 - 180) * \
+        math.cos(math.radians(constants.my_lat))
+    y = constants.earth_radius_km * numpy.radians(lats - constants.my_lat)
+    vx = speeds * numpy.sin(tracks)
+    vy = speeds * numpy.cos(tracks)
+    # time of closest approach to home, limited to the next horizon seconds
+    closest = numpy.clip(-(x * vx + y * vy) / numpy.maximum(speeds ** 2, 1e-9), 0, horizon)
+    closest_distance = numpy.hypot(x + vx * closest, y + vy * closest)
+
+    outside = get_distances(constants.home, lats, lons) > constants.airspace_radius_km
+    entering = numpy.nonzero(outside & (closest_distance <= constants.airspace_radius_km))[0]
+    return [moving[index] for index in entering]
+
+
+def get_bearings(point, lats, lons):
+    # get_bearing for a whole numpy array of positions at once
+    lat1 = math.radians(point[0])
+    lat2 = numpy.radians(lats)
+    diff_lon = numpy.radians(lons - point[1])
+
+    x = numpy.sin(diff_lon) * numpy.cos(lat2)
+    y = math.cos(lat1) * numpy.sin(lat2) - math.sin(lat1) * numpy.cos(lat2) * numpy.cos(diff_lon)
+
+    return (numpy.degrees(numpy.arctan2(x, y)) + 360) % 360
+
+
+def speed_to_kph(speed):
+    return speed * constants.knots_to_kph
+
+
+def dt_to_datetime(dt):
+    return datetime.datetime.fromtimestamp(int(dt)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def datetime_to_dt(formatted_datetime):
+    return int(datetime.datetime.strptime(formatted_datetime, '%Y-%m-%d %H:%M:%S').timestamp())
+
+
+def heading_to_direction(heading):
+    if heading > 348.75 or heading < 11.25:
+        return "N"
+    elif heading >= 11.25 and heading < 33.75:
+        return "NNE"
+    elif heading >= 33.75 and heading < 56.25:
+        return "NE"
+    elif heading >= 56.25 and heading < 78.75:
+        return "ENE"
+    elif heading >= 78.75 and heading < 101.25:
+        return "E"
+    elif heading >= 101.25 and heading < 123.75:
+        return "ESE"
+    elif heading >= 123.75 and heading < 146.25:
+        return "SE"
+    elif heading >= 146.25 and heading < 168.75:
+        return "SSE"
+    elif heading >= 168.75 and heading < 191.25:
+        return "S"
+    elif heading >= 191.25 and heading < 213.75:
+        return "SSW"
+    elif heading >= 213.75 and heading < 236.25:
+        return "SW"
+    elif heading >= 236.25 and heading < 258.75:
+        return "WSW"
+    elif heading >= 258.75 and heading < 281.25:
+        return "W"
+    elif heading >= 281.25 and heading < 303.75:
+        return "WNW"
+    elif heading >= 303.75 and heading < 326.25:
+        return "NW"
+    else:  # heading >= 326.25 and heading < 348.75
+        return "NNW"
+
+
+# lower edge of each compass point after N, in the same order as heading_to_direction
+compass_points = ["N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE", "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW"]
+compass_bounds = numpy.array([11.25, 33.75, 56.25, 78.75, 101.25, 123.75, 146.25, 168.75, 191.25, 213.75, 236.25,
+                              258.75, 281.25, 303.75, 326.25])
+
+
+def headings_to_directions(headings):
+    # heading_to_direction for a whole numpy array of headings. Same boundaries, including NNW up to and including
+    #  348.75 and N above it
+    indexes = numpy.searchsorted(compass_bounds, headings, side='right')
+    indexes[headings > 348.75] = 0
+    return [compass_points[index] for index in indexes]
+
+
+def check_current_weather():
+    # the in-memory weather. Stale weather is refreshed in the background, so this never waits on OWM or the database
+    #  None until the very first OWM query has come back on a brand new database
+    return weather.get()
+
+
+def create_sql_tables():
+    weather_table = "Create table if not exists weather (" \
+                    "datetime integer UNIQUE" \
+                    ", lat real" \
+                    ", long real" \
+                    ", desc text" \
+                    ", temp real" \
+                    ", pressure integer" \
+                    ", humidity integer" \
+                    ", visibility integer" \
+                    ", lastchecked integer" \
+                    ")"
+
+    # the original aircraft layout. Migration 6 moves its rows into the sightings table and leaves a read-only aircraft
+    #  view in its place, after which this is a no-op
+    aircraft_table = "Create table if not exists aircraft (" \
+                     "aircraft_key text" \
+                     ", aircraft text" \
+                     ", tail_number text" \
+                     ", flight_number text" \
+                     ", desc text" \
+                     ", fa_url text" \
+                     ", speed real" \
+                     ", altitude integer" \
+                     ", heading integer" \
+                     ", icao_code text" \
+                     ", squawk text" \
+                     ", tweet_status integer" \
+                     ", time_entered text" \
+                     ", time_exited text" \
+                     ", lat real" \
+                     ", lon real" \
+                     ")"
+    aircraft_details_table = "Create table if not exists aircraft_type_details (" \
+                             "aircraft_type text" \
+                             ", description text" \
+                             ", engine_count integer" \
+                             ", engine_type text" \
+                             ", manufacturer text" \
+                             ", type text" \
+                             ")"
+
+    airline_details_table = "Create table if not exists airline_details (" \
+                            "airline_code text" \
+                            ", callsign text" \
+                            ", country text" \
+                            ", location text" \
+                            ", name text" \
+                            ", phone text" \
+                            ", shortname text" \
+                            ", url text" \
+                            ")"
+
+    tail_owner_table = "Create table if not exists tail_owner (" \
+                            "ident text" \
+                            ", location text" \
+                            ", location2 text" \
+                            ", owner text" \
+                            ", website text" \
+                            ")"
+
+    # grab the shared database connection
+    conn = database.get_connection()
+
+    # get the cursor so we can do stuff
+    cur = conn.cursor()
+
+    # create our tables
+    cur.execute(weather_table)
+    conn.commit()
+    cur.execute(aircraft_table)
+    conn.commit()
+    cur.execute(aircraft_details_table)
+    conn.commit()
+    cur.execute(airline_details_table)
+    conn.commit()
+    cur.execute(tail_owner_table)
+    conn.commit()
+
+    # bring older databases up to the current schema (indexes, unique keys)
+    database.migrate()
+
+    # close the cursor. The connection stays open for the next query
+    cur.close()
+
+
+def aircraft_exists(icao, squawk):
+    # find the most recent entry for this aircraft in the active session table
+    this_aircraft = sessions.get(icao)
+    metrics.count_cache("sessions", this_aircraft is not None)
+    now = int(time.time())
+    if this_aircraft is None:
+        # this aircraft has never been in our airspace, or its last visit has already expired
+        return False
+    else:
+        this_aircraft['last_seen'] = now
+        recent_squawk = this_aircraft['squawk']
+        # if the newest entry in the database is older than X seconds ago, we know it's a new flight
+        if this_aircraft['entered'] + constants.squawk_delay < now:
+            return False
+        # if this squawk is the same as the previous one, this is already recorded
+        elif recent_squawk == squawk:
+            return True
+        # if this is just a case of the aircraft turning off it's squawk code we should ignore it. Not a new entry
+        elif recent_squawk != 'none' and squawk == 'none':
+            return True
+        # if this aircraft had no squawk and now does, let's update that but not record it as a new entry
+        elif recent_squawk == 'none' and squawk != 'none':
+            # send the update query to SQL
+            update_aircraft_query = "update sightings set squawk = (?) where icao_code = (?) and entered = (?)"
+            update_aircraft_values = [squawk, icao, this_aircraft['entered']]
+            database.queue_write(update_aircraft_query, update_aircraft_values)
+            this_aircraft['squawk'] = squawk
+            logger.debug("%s: set squawk value to %s", icao, squawk)
+            return True
+        # Last possible case is if the squawk code changed to a different valid value. Already cataloged.
+        else:
+            return True
+
+
+def is_unknown_aircraft(icao):
+    retry_at = unknown_aircraft.get(icao)
+    if retry_at is not None and retry_at <= time.monotonic():
+        unknown_aircraft.pop(icao, None)
+        retry_at = None
+    metrics.count_cache("unknown_aircraft", retry_at is not None)
+    return retry_at is not None
+
+
+def remember_unknown_aircraft(icao):
+    unknown_aircraft[icao] = time.monotonic() + constants.unknown_aircraft_ttl
+
+
+def forget_expired_unknown_aircraft():
+    now = time.monotonic()
+    expired = [icao for icao, retry_at in list(unknown_aircraft.items()) if retry_at <= now]
+    for icao in expired:
+        unknown_aircraft.pop(icao, None)
+    return expired.__len__()
+
+
+def check_if_known(airplane, aircraft_db):
+    url = constants.flightaware_url + "modes/" + airplane['hex'] + "/redirect"
+    try:
+        metrics.count_api_call("FA redirect")
+        # only the redirect itself is needed, not the page it points to. Anything other than a redirect means
+        #  FlightAware didn't send us anywhere
+        response = http_client.get(url, allow_redirects=False)
+        response.raise_for_status()
+        if response.is_redirect:
+            redirect_url = urllib.parse.urljoin(url, response.headers['Location'])
+        else:
+            redirect_url = url
+    except requests.exceptions.HTTPError as e:
+        logger.warning("FlightAware HTTP Error: %s", e)
+        return None
+    except requests.exceptions.ConnectionError as e:
+        logger.warning("FlightAware URL Error: %s - Check network connections", e)
+        return None
+    except Exception as e:
+        logger.exception("Error accessing flightaware.com. Unable to check aircraft")
+        return None
+
+    known_info = {'fl_num': 'x', 'redirect_url': 'y'}
+    # if the redirect gave us the flight details enter it
+    if url != redirect_url:
+        known_info['fl_num'] = redirect_url.split('/')[5]
+        known_info['redirect_url'] = redirect_url
+    # or possibly the flight number info is being sent by the aircraft itself
+    elif 'flight' in airplane:
+        known_info['fl_num'] = airplane['flight'].replace(' ', '')
+        known_info['redirect_url'] = constants.flightaware_url + "flight/" + known_info['fl_num']
+    # next we can try to look up using the local FR24 aircraft DB if it's available
+    elif aircraft_db is not None:
+        # here we will check the csv file database file
+        try:
+            if '~' in airplane['hex']:
+                airplane_hex = airplane['hex'][1:]
+            else:
+                airplane_hex = airplane['hex']
+            # primary key lookup in the indexed copy of the csv, then tidy up the ident string
+            ident = aircraft_db.lookup(airplane_hex).replace(' ', '').replace('-', '').upper()
+            # tail number != flight number but the URLs load the same page info, and return the same API data
+            known_info['fl_num'] = ident
+            known_info['redirect_url'] = constants.flightaware_url + "flight/" + ident
+            logger.debug("%s: Flight info retrieved from local FR24 db (Tail #%s)", airplane_hex, ident)
+        except Exception as e:
+            logger.debug("ICAO hex code %s missing from local FR24 db. No details available.", airplane['hex'])
+            known_info = None
+    else:
+        known_info = None
+
+    # nobody knows this one. Don't bother asking again until the negative cache entry runs out
+    #  (network errors return early above, so those get retried on the next poll)
+    if known_info is None:
+        remember_unknown_aircraft(airplane['hex'])
+
+    return known_info
+
+
+def get_flight_info_status(ident):
+    # FlightInfoStatus results are cached in the database so repeat visits (or the same flight number coming back
+    #  after squawk_delay) don't burn through the FXML quota
+    now = int(time.time())
+    conn = database.get_connection()
+    with database.lock:
+        cached = conn.execute("select response from fxml_flightinfo_cache where ident = (?) and expires > (?)",
+                              [ident, now]).fetchone()
+    metrics.count_cache("fxml_flightinfo", cached is not None)
+    if cached is not None:
+        logger.debug("%s: FlightInfoStatus found in cache. No need to query FXML API", ident)
+        return http_client.decode(cached[0])
+
+    payload = {'ident': ident, 'howMany': constants.fxml_flightinfo_limit}
+    try:
+        metrics.count_api_call("FlightInfoStatus")
+        response = http_client.get(constants.fxmlUrl + "FlightInfoStatus", params=payload,
+                                   auth=(constants.fa_username, constants.fxml_key))
+        if response.status_code != 200:
+            return None
+        flight_data = http_client.decode(response.content)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.warning("Error accessing FXML API: %s", e)
+        return None
+
+    # flights still in the air can change quickly (delays, diversions), finished ones won't change at all
+    #  a result with no active flight gets the short ttl too. That's what FXML returns when its data lags behind an
+    #  aircraft that's overhead right now, and we don't want to call it an unknown flight for the rest of the day.
+    #  Likewise anything without a result (not tracked, or an FXML error), so a passing error can't send the ident
+    #  down the private flight path for a whole day
+    ttl = constants.fxml_cache_ttl_in_progress
+    if 'FlightInfoStatusResult' in flight_data:
+        flights = flight_data['FlightInfoStatusResult']['flights']
+        if flights.__len__() and all(flight['progress_percent'] >= 100 for flight in flights):
+            ttl = constants.fxml_cache_ttl_completed
+    cache_insert = "insert or replace into fxml_flightinfo_cache values (?,?,?,?);"
+    with database.lock:
+        conn.execute(cache_insert, [ident, http_client.encode(flight_data), now, now + ttl])
+    return flight_data
+
+
+def get_flight_info(airplane, aircraft_db):
+    aircraft_type = None
+    airline_code = None
+
+    deets = check_if_known(airplane, aircraft_db)
+
+    # If Flight Aware doesn't have detail on a specific flight we can't get any good details
+    if deets is None:
+        logger.debug("%s: flight unknown to FlightAware", airplane['hex'])
+        flight_info = None
+        no_details = True
+
+    else:
+        no_details = False
+
+        # from the flight number we can get much more detail from the FA API
+        flight_data = get_flight_info_status(deets['fl_num'])
+
+        if flight_data is not None:
+            # the flight data will contain up to 15 cataloged flights for this flight number. We only want
+            #  the current in-progress flight
+            if 'FlightInfoStatusResult' in flight_data:
+                for flight in flight_data['FlightInfoStatusResult']['flights']:
+                    # there is an edge case here where all flights are inactive. Consider this an 'unknown flight'
+                    if 0 <= flight['progress_percent'] < 100:
+                        if 'full_aircrafttype' in flight:
+                            aircraft_type = flight['full_aircrafttype']
+                        elif 'aircrafttype' in flight:
+                            aircraft_type = flight['aircrafttype']
+                        else:
+                            aircraft_type = "Unknown"
+                        if 'airline' in flight:
+                            airline_code = flight['airline']
+                            airline = get_airline_info(flight['airline'])
+                            if 'airline_iata' in flight:
+                                iata = flight['airline_iata']
+                            else:
+                                iata = flight['airline']
+                            origin = flight['origin']['airport_name']
+                            destination = flight['destination']['airport_name']
+                            flight_num = flight['flightnumber']
+                        else:
+                            airline = "Private Flight"
+                            iata = "n/a"
+                            flight_num = deets['fl_num']
+                        if flight['origin']['airport_name'] == '':
+                            origin = flight['origin']['code']
+                        else:
+                            origin = flight['origin']['airport_name']
+                        if flight['destination']['airport_name'] == '':
+                            destination = flight['destination']['code']
+                        else:
+                            destination = flight['destination']['airport_name']
+                        flight_desc = airline + " (" + iata + ") #" + flight_num + " from " + origin + " to " + \
+                                      destination
+                        fa_url = deets['redirect_url']
+                        if 'tailnumber' in flight:
+                            tail_number = flight['tailnumber']
+                        else:
+                            tail_number = flight_num
+                        break
+                # possible that no flights show as active. FXML would not be returning accurate data if so.
+                if aircraft_type is None:
+                    logger.debug("%s: no active flights found", airplane['hex'])
+                    flight_desc = "unknown flight"
+                    fa_url = "unknown flight"
+                    tail_number = deets['fl_num']
+            else:
+                logger.debug("%s: this aircraft has requested to not be tracked", airplane['hex'])
+                #check if we have owner information for this tail number yet
+                query = "select * from tail_owner where ident = (?) limit 1"
+                # grab the shared database connection
+                conn = database.get_connection()
+                # get the cursor so we can do stuff
+                cur = conn.cursor()
+                # lookups can run on several enrichment threads at once, so take turns on the connection
+                with database.lock:
+                    cur.execute(query, [deets['fl_num']])
+                    # run the query to see if this one is entered yet
+                    this_ident = cur.fetchone()
+                metrics.count_cache("tail_owner", this_ident is not None)
+                if this_ident is not None:
+                    # set the flight info based on what the table says
+                    flight_desc = "Private flight: " + deets['fl_num'] + " - is unavailable for public tracking\n" + \
+                                  "Owner: " + this_ident[3] + " (" + this_ident[1] + ")"
+                    cur.close()
+                    logger.debug("%s found in Tail Owners table. No need to query FXML API", deets['fl_num'])
+                else:
+                    # this aircraft has never been in our airspace, check the API
+                    payload = {'ident': deets['fl_num']}
+                    # no error checking here. Bold assumption that if the API call above worked, this one will too
+                    metrics.count_api_call("TailOwner")
+                    response = http_client.get(constants.fxmlUrl + "TailOwner", params=payload,
+                                            auth=(constants.fa_username, constants.fxml_key))
+                    aircraft_data = http_client.decode(response.content)
+                    flight_desc = "Private flight: " + deets['fl_num'] + " - is unavailable for public tracking\n" + \
+                                  "Owner: " + aircraft_data['TailOwnerResult']['owner'].replace('&quot;', '"') + " (" + \
+                                  aircraft_data['TailOwnerResult']['location'] + ")"
+                    # we must also update the tail_owner table so next time the API doesn't need to be queried
+                    tail_insert = "insert or ignore into tail_owner values (?,?,?,?,?);"
+                    tail_values = [deets['fl_num'],
+                                   aircraft_data['TailOwnerResult']['location'],
+                                   aircraft_data['TailOwnerResult']['location2'],
+                                   aircraft_data['TailOwnerResult']['owner'].replace('&quot;', '"'),
+                                   aircraft_data['TailOwnerResult']['website']
+                                   ]
+                    with database.lock:
+                        cur.execute(tail_insert, tail_values)
+                    cur.close()
+                    logger.info("%s added to Tail Owners table", deets['fl_num'])
+
+                aircraft_type = "Unknown"
+                fa_url = "private flight"
+                tail_number = deets['fl_num']
+
+            # now we can start building the dict
+            if aircraft_type is None:
+                logger.warning("%s: no aircraft type in flight info", airplane['hex'])
+            flight_info = {"aircraft": aircraft_type,
+                           "airline_code": airline_code,
+                           "flight_number": deets['fl_num'],
+                           "desc": flight_desc,
+                           "fa_url": fa_url,
+                           "tail_number": tail_number
+                           }
+        else:
+            logger.debug("%s: Error retrieving data upstream", airplane['hex'])
+            flight_info = None
+
+    if no_details:
+        flight_info = "ignore me"
+    else:
+        # pull out the squawk code
+        if 'squawk' in airplane:
+            squawk = airplane['squawk']
+        else:
+            squawk = "none"
+
+        if 'gs' in airplane:
+            speed = round(speed_to_kph(airplane['gs']), 2)
+        else:
+            speed = 0
+        if 'track' in airplane:
+            track = airplane['track']
+        else:
+            track = 0
+
+        if flight_info is not None:
+            # fill the dict with all other relevant values, direct from the aircraft itself
+            flight_info['speed'] = speed
+            if 'alt_baro' in airplane:
+                flight_info['altitude'] = airplane['alt_baro']
+            else:
+                flight_info['altitude'] = 0
+            flight_info['heading'] = track
+            flight_info['icao_code'] = airplane['hex']
+            flight_info['squawk'] = squawk
+            flight_info['tweet_status'] = 0
+            flight_info['entered'] = int(time.time())
+            flight_info['exited'] = None
+            flight_info['lat'] = airplane['lat']
+            flight_info['lon'] = airplane['lon']
+
+        else:
+            # there's not much data available for this one. grab in what we can
+            if 'gs' in airplane:
+                speed = round(speed_to_kph(airplane['gs']), 2)
+            else:
+                speed = 0
+            if 'alt_baro' in airplane:
+                alt = airplane['alt_baro']
+            else:
+                alt = 0
+            if 'heading' in airplane:
+                head = airplane['track']
+            else:
+                head = 0
+            flight_info = {"aircraft": 'none',
+                           "airline_code": None,
+                           "tail_number": 'none',
+                           "flight_number": 'none',
+                           "desc": 'none',
+                           "fa_url": 'none',
+                           "speed": speed,
+                           "altitude": alt,
+                           "heading": head,
+                           "icao_code": airplane['hex'],
+                           "squawk": squawk,
+                           "tweet_status": 0,
+                           "entered": int(time.time()),
+                           "exited": None,
+                           "lat": airplane['lat'],
+                           "lon": airplane['lon']
+                           }
+
+    return flight_info
+
+
+def enrich_aircraft(airplane, aircraft_db):
+    # everything we need to know about a newly seen aircraft. Safe to run on an enrichment worker thread
+    flight_info = get_flight_info(airplane, aircraft_db)
+
+    # also find out more details about the type of aircraft
+    # TODO must deal with the edge case where this is NoneType. Check icao c036d2 from flightinfostatus API
+    if flight_info != "ignore me" and flight_info['aircraft'] != "none" and flight_info['aircraft'] != "Unknown":
+        if flight_info['aircraft'] is None:
+            logger.warning("%s: aircraft type missing, skipping aircraft type details", airplane['hex'])
+        else:
+            get_aircraft_info(flight_info['aircraft'])
+
+    return flight_info
+
+
+def get_enrichment_pool():
+    global enrichment_pool
+    if enrichment_pool is None:
+        enrichment_pool = concurrent.futures.ThreadPoolExecutor(max_workers=constants.enrichment_workers,
+                                                                thread_name_prefix="enrichment")
+    return enrichment_pool
+
+
+def prefetch_enrichment(approaching, aircraft_db):
+    # start the lookups for aircraft that are about to enter our airspace, so their details are ready (or nearly)
+    #  by the time they cross into it. Returns how many were started
+    started = 0
+    for airplane in approaching:
+        if prefetched.__len__() >= constants.prefetch_limit:
+            break
+        icao = airplane['hex']
+        if icao in prefetched or sessions.get(icao) is not None or is_unknown_aircraft(icao):
+            continue
+        # the dict is shared with the feed, and will be updated (or replaced) on later polls. Look up a copy
+        future = get_enrichment_pool().submit(enrich_aircraft, dict(airplane), aircraft_db)
+        prefetched[icao] = {'future': future, 'expires': time.monotonic() + constants.prefetch_horizon * 2}
+        logger.debug("%s: projected to enter our airspace. Looking it up early", icao)
+        started += 1
+    return started
+
+
+def discard_prefetches(approaching=None):
+    # throw away lookups for aircraft that turned away or never turned up. Ones still waiting for a worker are
+    #  cancelled, finished ones are just dropped. Pass the latest approaching list to drop anything no longer on it
+    now = time.monotonic()
+    still_approaching = None if approaching is None else set(airplane['hex'] for airplane in approaching)
+    discarded = [icao for icao, entry in prefetched.items()
+                 if entry['expires'] < now or (still_approaching is not None and icao not in still_approaching)]
+    for icao in discarded:
+        prefetched.pop(icao)['future'].cancel()
+    return discarded.__len__()
+
+
+def refresh_position(flight_info, airplane):
+    # a prefetched lookup was made with the aircraft's position from before it entered our airspace. Bring everything
+    #  that describes the aircraft itself up to date, as if the lookup had been made now
+    squawk = airplane.get('squawk', "none")
+    flight_info['speed'] = round(speed_to_kph(airplane['gs']), 2) if 'gs' in airplane else 0
+    flight_info['altitude'] = airplane.get('alt_baro', 0)
+    flight_info['heading'] = airplane.get('track', 0)
+    flight_info['squawk'] = squawk
+    flight_info['entered'] = int(time.time())
+    flight_info['lat'] = airplane['lat']
+    flight_info['lon'] = airplane['lon']
+    return flight_info
+
+
+def enrich_new_aircraft(new_aircraft, aircraft_db):
+    # run the FlightAware/FXML lookups for every new aircraft in this cycle at the same time, handing back
+    #  (airplane, flight_info) pairs as each one finishes so a slow lookup doesn't hold up the others
+    # aircraft that were looked up ahead of time pick up the prefetched result rather than starting again
+    futures = {}
+    for airplane in new_aircraft:
+        entry = prefetched.pop(airplane['hex'], None)
+        metrics.count_cache("prefetch", entry is not None and not entry['future'].cancelled())
+        if entry is not None and not entry['future'].cancelled():
+            futures[entry['future']] = (airplane, True)
+        else:
+            futures[get_enrichment_pool().submit(enrich_aircraft, airplane, aircraft_db)] = (airplane, False)
+    for future in concurrent.futures.as_completed(futures):
+        airplane, was_prefetched = futures[future]
+        try:
+            flight_info = future.result()
+            if was_prefetched and flight_info != "ignore me":
+                flight_info = refresh_position(flight_info, airplane)
+        except Exception as e:
+            # one bad lookup shouldn't take down the whole cycle. Treat it like an unknown flight
+            logger.exception("%s: error retrieving flight info", airplane['hex'])
+            flight_info = "ignore me"
+        yield airplane, flight_info
+
+
+def commit_flight_info(flight_dict):
+    # keyed on icao code plus the epoch time it entered our airspace
+    aircraft_insert = "insert or ignore into sightings (icao_code, entered, exited, aircraft, tail_number" \
+                      ", flight_number, desc, fa_url, speed, altitude, heading, squawk, tweet_status, lat, lon" \
+                      ", airline_code) values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?);"
+    aircraft_values = [flight_dict['icao_code'],
+                       flight_dict['entered'],
+                       flight_dict['exited'],
+                       flight_dict['aircraft'],
+                       flight_dict['tail_number'],
+                       flight_dict['flight_number'],
+                       flight_dict['desc'],
+                       flight_dict['fa_url'],
+                       flight_dict['speed'],
+                       flight_dict['altitude'],
+                       flight_dict['heading'],
+                       flight_dict['squawk'],
+                       flight_dict['tweet_status'],
+                       flight_dict['lat'],
+                       flight_dict['lon'],
+                       flight_dict['airline_code']
+                       ]
+
+    # buffered until the end of the poll cycle, then written with everything else in one transaction
+    database.queue_write(aircraft_insert, aircraft_values)
+    logger.debug("%s: queued for sightings table", flight_dict['icao_code'])
+    # the traffic stats are counted as we go rather than worked out from the whole table later
+    traffic_stats.record(flight_dict)
+    # keep the session table in step with the database so the next poll doesn't have to look this up
+    sessions.start(flight_dict['icao_code'], flight_dict['squawk'], flight_dict['entered'])
+
+
+def lookup_lock(kind, code):
+    with _lookup_locks_lock:
+        lock = _lookup_locks.get((kind, code))
+        if lock is None:
+            lock = threading.Lock()
+            _lookup_locks[(kind, code)] = lock
+    return lock
+
+
+def get_aircraft_info(aircraft_type):
+    # one lookup per aircraft type at a time. Other workers wanting the same one wait for it and then find it in the
+    #  database, rather than all missing the cache together and each asking FXML
+    with lookup_lock("aircraft_type", aircraft_type):
+        # check the database first
+        query = "select * from aircraft_type_details where aircraft_type = (?)"
+        # grab the shared database connection
+        conn = database.get_connection()
+        # get the cursor so we can do stuff
+        cur = conn.cursor()
+        with database.lock:
+            cur.execute(query, [aircraft_type])
+            # run the query to see if this one is written yet
+            this_aircraft = cur.fetchone()
+        metrics.count_cache("aircraft_type_details", this_aircraft is not None)
+
+        if this_aircraft is None:
+            logger.debug("No details for %s. Querying FlightXML", aircraft_type)
+            payload = {'type': aircraft_type}
+            data = None
+            try:
+                metrics.count_api_call("AircraftType")
+                response = http_client.get(constants.fxmlUrl + "AircraftType", params=payload,
+                                           auth=(constants.fa_username, constants.fxml_key))
+                if response.status_code == 200:
+                    # parse the body once, and only once
+                    data = http_client.decode(response.content)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                data = None
+            if data is not None and 'AircraftTypeResult' in data:
+                # parse this out and write to the database
+                aircraft_type_insert = "insert or ignore into aircraft_type_details values (?,?,?,?,?,?);"
+                # aircraft_type text, description text, engine_count integer, engine_type text, manufacturer text
+                aircraft_type_values = [aircraft_type,
+                                        data['AircraftTypeResult']['description'],
+                                        data['AircraftTypeResult']['engine_count'],
+                                        data['AircraftTypeResult']['engine_type'],
+                                        data['AircraftTypeResult']['manufacturer'],
+                                        data['AircraftTypeResult']['type']
+                                        ]
+                with database.lock:
+                    cur.execute(aircraft_type_insert, aircraft_type_values)
+                logger.info("%s: written to aircraft_type_details table", aircraft_type)
+
+            else:
+                logger.warning("Error accessing FlightXML. No details for %s", aircraft_type)
+
+        else:
+            logger.debug("Aircraft type details exist for %s. No need to query FXML API", aircraft_type)
+
+        cur.close()
+
+
+def tweet(current_weather):
+    # one query for the whole batch. The left join brings the aircraft type details along with each row, and the
+    #  limit keeps a big backlog (e.g. after an outage) from being tweeted all in one go
+    query = "select sightings.icao_code, sightings.entered, sightings.aircraft, sightings.tail_number" \
+            ", sightings.flight_number, sightings.desc, sightings.fa_url, sightings.speed, sightings.altitude" \
+            ", sightings.heading, sightings.lat, sightings.lon" \
+            ", aircraft_type_details.aircraft_type as details_type" \
+            ", aircraft_type_details.manufacturer, aircraft_type_details.type" \
+            " from sightings left join aircraft_type_details" \
+            " on aircraft_type_details.aircraft_type = sightings.aircraft" \
+            " where sightings.tweet_status = 0 and sightings.aircraft is not null and sightings.aircraft != 'none'" \
+            " order by sightings.entered asc limit (?)"
+    conn = database.get_connection()
+    # get the cursor so we can do stuff. Rows come back with named columns
+    cur = conn.cursor()
+    cur.row_factory = sqlite3.Row
+    with database.lock:
+        cur.execute(query, [constants.tweet_batch_size])
+        aircrafts_to_tweet = cur.fetchall()
+    cur.close()
+
+    # anything already waiting in the dispatcher queue has been composed, no need to do it again
+    aircrafts_to_tweet = [aircraft for aircraft in aircrafts_to_tweet
+                          if not tweet_dispatcher.is_pending((aircraft['icao_code'], aircraft['entered']))]
+    if aircrafts_to_tweet.__len__() == 0:
+        return
+
+    # work out where each aircraft is coming from, and where it's heading, for the whole batch at once
+    bearings = get_bearings(constants.home,
+                            numpy.array([aircraft['lat'] for aircraft in aircrafts_to_tweet], dtype=float),
+                            numpy.array([aircraft['lon'] for aircraft in aircrafts_to_tweet], dtype=float))
+    directions = headings_to_directions(bearings)
+    headings = headings_to_directions(numpy.array([aircraft['heading'] for aircraft in aircrafts_to_tweet],
+                                                  dtype=float))
+
+    for aircraft, direction, heading in zip(aircrafts_to_tweet, directions, headings):
+        message = "Incoming from the " + direction + "!\n"
+        # flight description
+        message += aircraft['desc'] + "\n"
+        # aircraft type
+        if aircraft['aircraft'] == "Unknown":  # aircraft type (ex. B737 or A320)
+            message += "Aircraft type: unavailable\n"
+        else:
+            message += "Flight # " + aircraft['flight_number'] + "\n"
+            # plane details came along from the aircraft_type_details table in the join
+            if aircraft['details_type'] is None:
+                message += "Aircraft: Unknown \n"
+            else:
+                message += "Aircraft: " + aircraft['manufacturer'] + " " + aircraft['type'] + "\n"
+        # FA url. The dispatcher shortens it just before sending, so bitly can't hold up the poll loop either
+        url = None
+        if aircraft['fa_url'].startswith("http"):
+            url = aircraft['fa_url']
+            message += "Details: " + tweet_dispatcher.link_marker + "\n"
+        # additional nice to know details
+        message += "Tail # " + aircraft['tail_number'] + "\n"
+        message += "Speed: " + str(int(aircraft['speed'])) + " km/hr heading " + heading + "\n"
+        message += "Alt: " + str(aircraft['altitude']) + " ft\n"
+        if current_weather is not None:
+            message += "Weather: " + current_weather['desc'] + "\n"
+        # message += "Ceiling: " + str(current_weather['visibility']) + " ft\n" # this value doesn't seem accurate
+        # TODO check other weather APIs, or if there's a better measure available from OWM
+
+        message += constants.hashtags + "\n"
+
+        logger.debug("Tweet character count: %d", message.__len__())
+        # hand it over to the background dispatcher. It fills in the link, trims the tweet to length and sets
+        #  tweet_status once the tweet is actually out
+        if tweet_dispatcher.enqueue((aircraft['icao_code'], aircraft['entered']), aircraft['icao_code'], message,
+                                    url=url):
+            logger.info("%s: tweet queued", aircraft['icao_code'])
+
+def get_airline_info(airline_code):
+    # like get_aircraft_info, only one worker looks up a given airline at a time
+    with lookup_lock("airline", airline_code):
+        # check the database first
+        query = "select * from airline_details where airline_code = (?)"
+        # grab the shared database connection
+        conn = database.get_connection()
+        # get the cursor so we can do stuff
+        cur = conn.cursor()
+        with database.lock:
+            cur.execute(query, [airline_code])
+            # run the query to see if this one is written yet
+            this_airline = cur.fetchone()
+        metrics.count_cache("airline_details", this_airline is not None)
+
+        if this_airline is None:
+            logger.debug("No details for %s. Querying FlightXML", airline_code)
+            payload = {'airline_code': airline_code}
+            data = None
+            try:
+                metrics.count_api_call("AirlineInfo")
+                response = http_client.get(constants.fxmlUrl + "AirlineInfo", params=payload,
+                                           auth=(constants.fa_username, constants.fxml_key))
+                if response.status_code == 200:
+                    # parse the body once, and only once
+                    data = http_client.decode(response.content)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                data = None
+            if data is not None and 'AirlineInfoResult' in data:
+                # parse this out and write to the database
+                airline_insert = "insert or ignore into airline_details values (?,?,?,?,?,?,?,?);"
+                # aircraft_type text, description text, engine_count integer, engine_type text, manufacturer text
+                airline_values = [airline_code,
+                                  data['AirlineInfoResult']['callsign'],
+                                  data['AirlineInfoResult']['country'],
+                                  data['AirlineInfoResult']['location'],
+                                  data['AirlineInfoResult']['name'],
+                                  data['AirlineInfoResult']['phone'],
+                                  data['AirlineInfoResult']['shortname'],
+                                  data['AirlineInfoResult']['url']
+                                  ]
+                with database.lock:
+                    cur.execute(airline_insert, airline_values)
+                logger.info("%s: written to airline_details table", airline_code)
+                # ideally we use the shortname for an airline. Use the full name if no shortname exists
+                if data['AirlineInfoResult']['shortname'] == '':
+                    airline_name = data['AirlineInfoResult']['name']
+                else:
+                    airline_name = data['AirlineInfoResult']['shortname']
+
+            else:
+                logger.warning("Error accessing FlightXML. No details for %s", airline_code)
+                airline_name = airline_code
+
+        else:
+            logger.debug("Airline details exist for %s. No need to query FXML API", airline_code)
+            if this_airline[6] == '':
+                airline_name = this_airline[4]
+            else:
+                airline_name = this_airline[6]
+
+        cur.close()
+        return airline_name
+
+
+def get_twitter_client():
+    # one client for the life of the process, created the first time there's something to tweet
+    global twitter_client
+    if twitter_client is None:
+        import twython
+        twitter_client = twython.Twython(constants.twitter_app_key, constants.twitter_app_secret,
+                                         constants.twitter_token, constants.twitter_token_secret)
+    return twitter_client
+
+
+def shorten_link(url):
+    # the same FlightAware urls come up over and over, so only ask bitly about each one once
+    if url in short_links:
+        metrics.count_cache("short_links", True)
+        return short_links[url]
+    conn = database.get_connection()
+    with database.lock:
+        cached = conn.execute("select short_url from short_links where long_url = (?)", [url]).fetchone()
+    metrics.count_cache("short_links", cached is not None)
+    if cached is not None:
+        short_links[url] = cached[0]
+        return cached[0]
+
+    global link_shortener
+    if link_shortener is None:
+        from bitlyshortener import Shortener
+        link_shortener = Shortener(tokens=[constants.bitly_token])
+    metrics.count_api_call("bitly")
+    short_link = link_shortener.shorten_urls([url])
+    if short_link is not None:
+        short_links[url] = short_link[0]
+        # committed with the rest of this cycle's writes
+        database.queue_write("insert or replace into short_links values (?,?);", [url, short_link[0]])
+        return short_link[0]
+    else:
+        return None
+
+def email_problem(exception_reason):
+    import smtplib
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    #build the message object
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = constants.subject
+    msg['From'] = constants.send_from
+    msg['To'] = constants.send_to
+
+    text = "No plain text option available. Use an HTML email client."
+    html = str(exception_reason)
+
+    # Record the MIME types of both parts - text/plain and text/html.
+    part1 = MIMEText(text, 'plain')
+    part2 = MIMEText(html, 'html')
+
+    #Attach parts into message container. According to RFC 2046, the last part of a multipart message, in this case
+    # the HTML message, is best and preferred.
+    msg.attach(part1)
+    msg.attach(part2)
+    
+    #now connect and send the email out
+    server = smtplib.SMTP(constants.smtp_server, constants.smtp_port)
+    server.ehlo()
+    server.sendmail(constants.send_from, constants.send_to, msg.as_string())
     server.quit()
\ No newline at end of file
@@ -0,0 +1,67 @@
+import json
+import threading
+import requests
+import requests.adapters
+import constants
+
+# orjson is optional. It decodes straight from bytes and is several times faster than the standard library on big
+#  aircraft.json feeds, but everything works without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# one requests session is shared by every outbound call (dump1090, FlightAware, FXML, OWM) so connections are kept
+#  alive and reused instead of paying for a new TCP/TLS handshake on each request. urllib3 keeps a separate
+#  connection pool for each host behind the scenes
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            # the pool has to be big enough for every enrichment worker to hold a connection to the same host
+            adapter = requests.adapters.HTTPAdapter(pool_connections=constants.http_pool_hosts,
+                                                    pool_maxsize=max(constants.http_pool_size,
+                                                                     constants.enrichment_workers))
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def get(url, **kwargs):
+    # never let a hung upstream server stall the poll loop forever
+    kwargs.setdefault('timeout', (constants.http_connect_timeout, constants.http_read_timeout))
+    return get_session().get(url, **kwargs)
+
+
+def decode(raw):
+    # parse a JSON body (bytes or str) exactly once, with orjson if it's installed
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def encode(data):
+    # the reverse of decode, returned as text so it can be stored in the database
+    if orjson is not None:
+        return orjson.dumps(data).decode('utf-8')
+    return json.dumps(data)
+
+
+def get_json(url, **kwargs):
+    # GET a url and decode its JSON body straight from the raw bytes. Raises for HTTP errors like raise_for_status
+    response = get(url, **kwargs)
+    response.raise_for_status()
+    return decode(response.content)
+
+
+def close():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
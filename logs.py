@@ -0,0 +1,123 @@
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+import constants
+
+# logging setup. Records are handed to a queue and written to stdout (and optionally a rotating log file) by a
+#  background listener thread, so the poll loop never blocks on terminal or SD card I/O
+# per-aircraft outcomes are counted rather than logged one by one, and written as a single summary line each cycle.
+#  Repeats of the same warning or error (e.g. the feed being down on every poll) are only logged every
+#  log_repeat_interval seconds
+
+logger = logging.getLogger("cycle")
+
+_listener = None
+_queue_handler = None
+_lock = threading.Lock()
+# outcome -> aircraft count for the current cycle
+outcomes = {}
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # never waits for room in the queue. If the writer has fallen that far behind, the record is dropped and counted
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class QueueWriter(logging.handlers.QueueListener):
+    # on shutdown, wait for room for the stop marker rather than failing if the queue happens to be full
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class RepeatFilter(logging.Filter):
+    # lets each distinct warning or error through once per interval. Keyed on the unformatted message, so the same
+    #  error with different details still counts as a repeat
+    def __init__(self, interval):
+        super().__init__()
+        self.interval = interval
+        self.last_logged = {}
+        self.suppressed = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            last = self.last_logged.get(key)
+            if last is not None and now - last < self.interval:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return False
+            self.last_logged[key] = now
+            repeats = self.suppressed.pop(key, 0)
+        if repeats:
+            record.msg = record.getMessage() + " (repeated " + str(repeats) + " times since last logged)"
+            record.args = None
+        return True
+
+
+def start():
+    # route everything logged through the queue. Safe to call more than once
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+    formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s", "%Y-%m-%d %H:%M:%S")
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if constants.log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(constants.log_file,
+                                                             maxBytes=constants.log_file_max_bytes,
+                                                             backupCount=constants.log_file_backups))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(constants.log_queue_size)
+    _queue_handler = DroppingQueueHandler(log_queue)
+    _queue_handler.addFilter(RepeatFilter(constants.log_repeat_interval))
+    root = logging.getLogger()
+    root.setLevel(constants.log_level)
+    root.addHandler(_queue_handler)
+
+    _listener = QueueWriter(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def stop():
+    # writes out whatever is still queued. Call this last on the way out
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    _listener.stop()
+    logging.getLogger().removeHandler(_queue_handler)
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+    _queue_handler = None
+
+
+def count(outcome, number=1):
+    with _lock:
+        outcomes[outcome] = outcomes.get(outcome, 0) + number
+
+
+def log_cycle_summary():
+    # one line covering every aircraft counted this cycle
+    with _lock:
+        summary = ", ".join(str(total) + " " + outcome for outcome, total in outcomes.items())
+        outcomes.clear()
+    if _queue_handler is not None and _queue_handler.dropped:
+        summary += (", " if summary else "") + str(_queue_handler.dropped) + " log lines dropped"
+        _queue_handler.dropped = 0
+    if summary:
+        logger.info(summary)
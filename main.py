@@ -1,93 +1,237 @@
-import json
-import urllib.request
-import helper_functions
-import constants
-import time
-import datetime
-import traceback
-import csv
-import pandas
-
-# TODO create a cron job to check each minute that this script is still running
-
-try:
-
-    # start by ensuring the SQL backend is set up
-    helper_functions.create_sql_tables()
-
-    if constants.fr24_licensed:
-        # import the static 'airplane db' file into a pandas dataframe
-        try:
-            aircraft_db = pandas.read_csv(constants.aircraft_db_name)
-        except Exception as e:
-            print("Error importing aircraft DB")
-            aircraft_db = None
-    else:
-        aircraft_db = None
-
-    while True:
-        # check the weather
-        weather = helper_functions.check_current_weather()
-
-        # make the web request to pull the json data from our antenna
-        req = urllib.request.Request(constants.live_data_url)
-        try:
-            data = json.loads(urllib.request.urlopen(req).read().decode('utf-8'))
-        except urllib.error.HTTPError as e:
-            print("HTTP Error: " + e.reason)
-            data = None
-        except urllib.error.URLError as e:
-            print("URL Error: " + e.reason.strerror + "\nCheck network connections")
-            data = None
-        except Exception as e:
-            print("General Exception. Error reaching " + constants.live_data_url)
-            data = None
-
-        # if we have valid aircraft data, run through each aircraft to see the details
-        if data is not None and data['aircraft'].__len__():
-            print(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') + ": Parsing " + str(data['aircraft'].__len__()) + " aircraft")
-            for airplane in data['aircraft']:
-                # print("==============================")
-                # print("ICAO code: " + airplane['hex'])
-                # we can't get distance location without knowing where the plane is
-                if 'lat' in airplane:
-                    # ignore this aircraft if it's outside of our airspace
-                    if helper_functions.get_distance(constants.home, (airplane['lat'], airplane['lon'])) <= \
-                            constants.airspace_radius_km:
-                        # grab squawk code
-                        if 'squawk' in airplane:
-                            squawk = airplane['squawk']
-                        else:
-                            squawk = "none"
-                        # check if this aircraft already exists in our local database
-                        if helper_functions.aircraft_exists(airplane['hex'], squawk):
-                            print(airplane['hex'] + ": already in database")
-                        else:
-                            # grab additional details from flightaware based on the icao code
-                            flight_info = helper_functions.get_flight_info(airplane, aircraft_db)
-
-                            # write this flight to the database
-                            if flight_info != "ignore me":
-                                print(airplane['hex'] + ": adding to database")
-                                helper_functions.commit_flight_info(flight_info)
-                            else:
-                                print(airplane['hex'] + ": no useful data - Ignoring")
-                    else:
-                        print(airplane['hex'] + ": outside our airspace - Ignoring")
-                else:
-                    print(airplane['hex'] + ": missing location information - Ignoring")
-
-
-        # now let's tweet about it
-        helper_functions.tweet(weather)
-
-        print("*************************")
-
-        # now wait a bit before checking everything again
-        time.sleep(constants.sleep_time)
-
-except Exception as e:
-    print(str(e))
-    print(traceback.format_exc())
-    print("Something broke")
-    helper_functions.email_problem("Program Crash\nException:\n" + str(e) + "\n\nStack trace:\n" + traceback.format_exc())
+import requests
+import helper_functions
+import database
+import http_client
+import sessions
+import tracks
+import weather
+import traffic_stats
+import tweet_dispatcher
+import aircraft_registry
+import sbs_stream
+import metrics
+import logs
+import logging
+import constants
+import time
+import signal
+import traceback
+import csv
+
+# TODO create a cron job to check each minute that this script is still running
+
+logger = logging.getLogger("main")
+
+# what we saw last poll, so unchanged snapshots and aircraft that haven't moved can be skipped
+last_snapshot = None
+last_positions = {}
+poll_interval = constants.sleep_time
+
+
+def process_in_range(in_range, aircraft_db):
+    new_aircraft = []
+    with metrics.timed("dedup"):
+        for airplane in in_range:
+            # grab squawk code
+            if 'squawk' in airplane:
+                squawk = airplane['squawk']
+            else:
+                squawk = "none"
+            # check if this aircraft already exists in our local database
+            if helper_functions.aircraft_exists(airplane['hex'], squawk):
+                logger.debug("%s: already in database", airplane['hex'])
+                logs.count("already in database")
+            elif helper_functions.is_unknown_aircraft(airplane['hex']):
+                logger.debug("%s: recently unknown to FlightAware - Ignoring", airplane['hex'])
+                logs.count("recently unknown to FlightAware")
+            else:
+                new_aircraft.append(airplane)
+
+    # grab additional details from flightaware for all the new aircraft at once, writing each one to the
+    #  database as soon as its lookups finish
+    with metrics.timed("enrichment"):
+        for airplane, flight_info in helper_functions.enrich_new_aircraft(new_aircraft, aircraft_db):
+            if flight_info != "ignore me":
+                logger.debug("%s: adding to database", airplane['hex'])
+                logs.count("added to database")
+                helper_functions.commit_flight_info(flight_info)
+            else:
+                logger.debug("%s: no useful data - Ignoring", airplane['hex'])
+                logs.count("with no useful data")
+
+    # add this cycle's positions to the tracks of everything we have an aircraft table entry for
+    tracks.record_positions(in_range)
+
+
+def look_ahead(aircraft_list, aircraft_db):
+    # start the lookups for aircraft about to cross into our airspace, and drop the ones for aircraft that turned away
+    #  this runs after process_in_range so anything that has just arrived has already picked up its early lookup
+    with metrics.timed("prediction"):
+        approaching = helper_functions.predict_entering(aircraft_list)
+        helper_functions.discard_prefetches(approaching)
+        started = helper_functions.prefetch_enrichment(approaching, aircraft_db)
+    if started:
+        logs.count("aircraft approaching, looked up early", started)
+
+
+def finish_cycle(current_weather):
+    # forget about aircraft whose squawk_delay window has closed
+    sessions.evict_expired()
+    helper_functions.forget_expired_unknown_aircraft()
+    # pack up the tracks of anything that has left our airspace and fill in its exit time
+    tracks.close_exited()
+
+    # write everything from this poll cycle out in one transaction
+    with metrics.timed("db_commit"):
+        database.flush()
+
+    # now let's tweet about it. This only queues the tweets up, the dispatcher thread sends them
+    with metrics.timed("tweet"):
+        helper_functions.tweet(current_weather)
+        traffic_stats.maybe_tweet_daily_summary()
+
+    metrics.update_backlog()
+    metrics.write_stats_file()
+
+    # one line for the whole cycle rather than one per aircraft
+    logs.log_cycle_summary()
+
+
+def poll_cycle(aircraft_db):
+    # one pass of the polling loop. Returns how long to wait before the next one
+    global last_snapshot, poll_interval
+    cycle_started = time.perf_counter()
+
+    # check the weather
+    with metrics.timed("weather"):
+        current_weather = helper_functions.check_current_weather()
+
+    # make the web request to pull the json data from our antenna
+    try:
+        with metrics.timed("fetch"):
+            response = http_client.get(constants.live_data_url)
+            response.raise_for_status()
+        # decoded straight from the raw bytes, with orjson if it's available
+        with metrics.timed("parse"):
+            data = http_client.decode(response.content)
+    except requests.exceptions.HTTPError as e:
+        logger.warning("HTTP Error: %s", e)
+        data = None
+    except requests.exceptions.ConnectionError as e:
+        logger.warning("URL Error: %s - Check network connections", e)
+        data = None
+    except Exception as e:
+        logger.warning("General Exception. Error reaching %s: %s", constants.live_data_url, e)
+        data = None
+
+    # dump1090 stamps each snapshot with its clock and a running message count. If neither has moved on,
+    #  nothing has changed since the last poll
+    if data is not None:
+        snapshot = (data.get('now'), data.get('messages'))
+        if snapshot[0] is not None and snapshot == last_snapshot:
+            logger.debug("aircraft.json unchanged since last poll - Skipping")
+            logs.count("unchanged snapshot")
+            data = None
+        last_snapshot = snapshot
+
+    # if we have valid aircraft data, run through each aircraft to see the details
+    if data is not None and data['aircraft'].__len__():
+        logs.count("aircraft parsed", data['aircraft'].__len__())
+        # only aircraft that have moved since the last poll could have crossed into our airspace
+        moved = helper_functions.changed_aircraft(data['aircraft'], last_positions)
+        # work out which aircraft are inside our airspace in one pass over the whole snapshot
+        with metrics.timed("distance_filter"):
+            in_range = helper_functions.filter_airspace(moved)
+        logs.count("unchanged, outside our airspace or missing location information",
+                   data['aircraft'].__len__() - in_range.__len__())
+        process_in_range(in_range, aircraft_db)
+        look_ahead(data['aircraft'], aircraft_db)
+        poll_interval = helper_functions.next_poll_interval(data['aircraft'])
+    elif data is not None:
+        # empty sky
+        helper_functions.discard_prefetches([])
+        poll_interval = constants.poll_interval_max
+    else:
+        # no new snapshot. Only let go of the early lookups that have been waiting too long
+        helper_functions.discard_prefetches()
+
+    finish_cycle(current_weather)
+    metrics.observe_stage("cycle", time.perf_counter() - cycle_started)
+    return poll_interval
+
+
+def handle_sigterm(signum, frame):
+    # systemd (or a watchdog) stops us with SIGTERM, which would otherwise end the process without running the finally
+    #  block in main(), and this cycle's buffered writes would be lost. Exit the normal way instead
+    logger.info("SIGTERM received. Shutting down")
+    raise SystemExit(0)
+
+
+def main():
+    # log lines are written from a background thread from here on
+    logs.start()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    try:
+
+        # start by ensuring the SQL backend is set up
+        helper_functions.create_sql_tables()
+
+        if constants.fr24_licensed:
+            # open the indexed copy of the static 'airplane db' file, (re)building it if the csv has changed
+            try:
+                aircraft_db = aircraft_registry.open_registry(constants.aircraft_db_name,
+                                                              constants.aircraft_db_index_name)
+            except Exception as e:
+                logger.error("Error importing aircraft DB: %s", e)
+                aircraft_db = None
+        else:
+            aircraft_db = None
+
+        # load the aircraft seen within the last squawk_delay so restarts don't double up entries
+        sessions.load()
+        # and the latest weather we have. From here on it's refreshed in the background as it goes stale
+        weather.load()
+        # fills in the traffic stats from the existing history the first time round
+        traffic_stats.load()
+
+        # tweets go out from a background thread so the Twitter API can't slow down polling
+        tweet_dispatcher.start()
+
+        # local /metrics endpoint for keeping an eye on cycle times and API quota
+        metrics.start_server()
+
+        # streaming mode: aircraft arrive from dump1090's SBS-1 output as soon as they move, in small batches
+        #  stream_batches keeps reconnecting forever, so this takes the place of the polling loop below
+        if constants.ingest_mode == "sbs":
+            for in_range in sbs_stream.stream_batches(constants.sbs_host, constants.sbs_port):
+                with metrics.timed("weather"):
+                    current_weather = helper_functions.check_current_weather()
+                if in_range.__len__():
+                    logs.count("aircraft moved inside our airspace", in_range.__len__())
+                    process_in_range(in_range, aircraft_db)
+                look_ahead(list(sbs_stream.aircraft_state.values()), aircraft_db)
+                finish_cycle(current_weather)
+
+        while True:
+            # now wait a bit before checking everything again
+            time.sleep(poll_cycle(aircraft_db))
+
+    except Exception as e:
+        logger.exception("Something broke")
+        helper_functions.email_problem("Program Crash\nException:\n" + str(e) + "\n\nStack trace:\n" +
+                                       traceback.format_exc())
+    finally:
+        # give the dispatcher a moment to finish what it's sending and record the tweet statuses
+        tweet_dispatcher.stop()
+        metrics.stop_server()
+        # write out the tracks of anything still in our airspace
+        tracks.close_all()
+        # make sure everything is flushed out of the WAL before we exit
+        database.close_connection()
+        http_client.close()
+        logs.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import contextlib
+import logging
+import http.server
+import os
+import threading
+import time
+import constants
+import database
+
+logger = logging.getLogger("metrics")
+
+# runtime instrumentation. Per-stage latency histograms for each poll cycle, counters for every outbound API call,
+#  cache hit ratios and the untweeted backlog, exposed in Prometheus text format on a local HTTP endpoint and/or
+#  written to a stats file every cycle
+# API calls are also tallied per calendar month in the database, so FXML quota burn survives restarts
+
+# histogram bucket upper bounds, in seconds
+buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+_lock = threading.Lock()
+# stage -> {'buckets': [count per bucket], 'sum': seconds, 'count': n}
+stage_histograms = {}
+# endpoint -> calls since startup
+api_calls = {}
+# (cache, 'hit' or 'miss') -> count
+cache_lookups = {}
+gauges = {'untweeted_backlog': 0}
+_server = None
+
+
+def observe_stage(stage, seconds):
+    with _lock:
+        histogram = stage_histograms.get(stage)
+        if histogram is None:
+            histogram = {'buckets': [0] * buckets.__len__(), 'sum': 0.0, 'count': 0}
+            stage_histograms[stage] = histogram
+        for index, bound in enumerate(buckets):
+            if seconds <= bound:
+                histogram['buckets'][index] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+
+@contextlib.contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+def stage_totals():
+    # stage -> total seconds observed so far
+    with _lock:
+        return {stage: histogram['sum'] for stage, histogram in stage_histograms.items()}
+
+
+def count_api_call(endpoint):
+    with _lock:
+        api_calls[endpoint] = api_calls.get(endpoint, 0) + 1
+    # monthly tally, written out with the rest of the cycle's database writes
+    database.queue_write("insert into api_usage values (?,?,1) "
+                         "on conflict(month, endpoint) do update set calls = calls + 1",
+                         [time.strftime('%Y-%m'), endpoint])
+
+
+def count_cache(cache, hit):
+    key = (cache, 'hit' if hit else 'miss')
+    with _lock:
+        cache_lookups[key] = cache_lookups.get(key, 0) + 1
+
+
+def set_gauge(name, value):
+    with _lock:
+        gauges[name] = value
+
+
+def update_backlog():
+    # the partial index on untweeted rows keeps this cheap
+    query = "select count(*) from sightings where tweet_status = 0 and aircraft is not null and aircraft != 'none'"
+    with database.lock:
+        backlog = database.get_connection().execute(query).fetchone()[0]
+    set_gauge('untweeted_backlog', backlog)
+
+
+def monthly_api_calls():
+    with database.lock:
+        return database.get_connection().execute("select endpoint, calls from api_usage where month = (?)",
+                                                  [time.strftime('%Y-%m')]).fetchall()
+
+
+def render():
+    # everything in Prometheus text exposition format
+    lines = []
+    with _lock:
+        lines.append("# HELP piaware_stage_seconds Time spent in each stage of a poll cycle")
+        lines.append("# TYPE piaware_stage_seconds histogram")
+        for stage, histogram in sorted(stage_histograms.items()):
+            for bound, count in zip(buckets, histogram['buckets']):
+                lines.append('piaware_stage_seconds_bucket{stage="' + stage + '",le="' + str(bound) + '"} ' +
+                             str(count))
+            lines.append('piaware_stage_seconds_bucket{stage="' + stage + '",le="+Inf"} ' + str(histogram['count']))
+            lines.append('piaware_stage_seconds_sum{stage="' + stage + '"} ' + str(round(histogram['sum'], 6)))
+            lines.append('piaware_stage_seconds_count{stage="' + stage + '"} ' + str(histogram['count']))
+
+        lines.append("# HELP piaware_api_calls_total Outbound API calls since startup")
+        lines.append("# TYPE piaware_api_calls_total counter")
+        for endpoint, calls in sorted(api_calls.items()):
+            lines.append('piaware_api_calls_total{endpoint="' + endpoint + '"} ' + str(calls))
+
+        lines.append("# HELP piaware_cache_lookups_total Cache lookups since startup")
+        lines.append("# TYPE piaware_cache_lookups_total counter")
+        for (cache, result), count in sorted(cache_lookups.items()):
+            lines.append('piaware_cache_lookups_total{cache="' + cache + '",result="' + result + '"} ' + str(count))
+
+        lines.append("# HELP piaware_cache_hit_ratio Share of cache lookups that were hits since startup")
+        lines.append("# TYPE piaware_cache_hit_ratio gauge")
+        for cache in sorted(set(cache for cache, result in cache_lookups)):
+            hits = cache_lookups.get((cache, 'hit'), 0)
+            total = hits + cache_lookups.get((cache, 'miss'), 0)
+            lines.append('piaware_cache_hit_ratio{cache="' + cache + '"} ' + str(round(hits / total, 4)))
+
+        lines.append("# HELP piaware_untweeted_backlog Aircraft waiting to be tweeted")
+        lines.append("# TYPE piaware_untweeted_backlog gauge")
+        lines.append("piaware_untweeted_backlog " + str(gauges['untweeted_backlog']))
+
+    lines.append("# HELP piaware_api_calls_month Outbound API calls so far this calendar month")
+    lines.append("# TYPE piaware_api_calls_month gauge")
+    try:
+        for endpoint, calls in monthly_api_calls():
+            lines.append('piaware_api_calls_month{endpoint="' + endpoint + '"} ' + str(calls))
+    except Exception as e:
+        logger.warning("Error reading monthly API usage: %s", e)
+    return "\n".join(lines) + "\n"
+
+
+def write_stats_file():
+    if not constants.metrics_file:
+        return
+    # write to a temporary file first so anything reading the stats never sees half a file
+    temp_name = constants.metrics_file + ".tmp"
+    with open(temp_name, 'w') as stats_file:
+        stats_file.write(render())
+    os.replace(temp_name, constants.metrics_file)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(body.__len__()))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server():
+    # serve /metrics on localhost. A port of 0 turns the endpoint off
+    global _server
+    if not constants.metrics_port or _server is not None:
+        return
+    try:
+        _server = http.server.ThreadingHTTPServer((constants.metrics_host, constants.metrics_port), MetricsHandler)
+    except OSError as e:
+        # e.g. something else already has the port. The bot runs fine without the endpoint
+        logger.warning("Unable to serve metrics on %s:%d: %s", constants.metrics_host, constants.metrics_port, e)
+        return
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Metrics available on http://%s:%d/metrics", constants.metrics_host, constants.metrics_port)
+
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server = None
@@ -2,8 +2,10 @@
 dbname=$(cat ~/piaware-alerts/constants.py | grep "db_name" -m 1| cut -d'"' -f 2)
 #get the date
 today=$(date +%Y-%m-%d)
-#create a copy of today's database with the date prepended to it
-cp ~/piaware-alerts/${dbname} ~/piaware-alerts/${today}${dbname}
+#create a consistent copy of today's database with the date prepended to it
+# the bot keeps the database open in WAL mode, so a plain cp could miss recent writes. The sqlite backup API reads a
+# consistent snapshot without blocking the bot
+sqlite3 ~/piaware-alerts/${dbname} ".backup '$HOME/piaware-alerts/${today}${dbname}'"
 #upload the copied database
 curl -T ~/piaware-alerts/${today}${dbname} ftp://192.168.1.165 --user ftpuser:ftppassword
 #delete the copy we had just created
@@ -0,0 +1,165 @@
+import logging
+import socket
+import sys
+import time
+import constants
+import helper_functions
+
+logger = logging.getLogger("sbs_stream")
+
+# streaming ingest from dump1090's SBS-1 (BaseStation) output, usually on port 30003, as an alternative to polling
+#  aircraft.json. Each line is one decoded message, so we keep our own per-aircraft state (in the same shape as the
+#  aircraft.json entries) and pass aircraft on as soon as a position update puts them inside our airspace
+# SBS-1 is already decoded by dump1090. Beast output is raw Mode S and would need full ADS-B (CPR) decoding, so it
+#  isn't supported here
+
+# SBS-1 field positions (0 based)
+MESSAGE_TYPE = 0
+TRANSMISSION_TYPE = 1
+HEX_IDENT = 4
+CALLSIGN = 10
+ALTITUDE = 11
+GROUND_SPEED = 12
+TRACK = 13
+LAT = 14
+LON = 15
+SQUAWK = 17
+
+# icao hex -> aircraft.json style dict
+aircraft_state = {}
+
+
+def parse_line(line):
+    # returns (hex, {field: value}) for a MSG line, or None for anything we can't use
+    fields = line.strip().split(',')
+    if fields.__len__() < 18 or fields[MESSAGE_TYPE] != 'MSG' or fields[HEX_IDENT] == '':
+        return None
+    updates = {}
+    try:
+        if fields[CALLSIGN] != '':
+            updates['flight'] = fields[CALLSIGN]
+        if fields[ALTITUDE] != '':
+            updates['alt_baro'] = int(float(fields[ALTITUDE]))
+        if fields[GROUND_SPEED] != '':
+            updates['gs'] = float(fields[GROUND_SPEED])
+        if fields[TRACK] != '':
+            updates['track'] = float(fields[TRACK])
+        if fields[LAT] != '' and fields[LON] != '':
+            updates['lat'] = float(fields[LAT])
+            updates['lon'] = float(fields[LON])
+        if fields[SQUAWK] != '':
+            updates['squawk'] = fields[SQUAWK]
+    except ValueError:
+        return None
+    return fields[HEX_IDENT].lower(), updates
+
+
+def apply_line(line, now):
+    # update our state with one SBS-1 line. Returns the aircraft if this line gave it a new position
+    parsed = parse_line(line)
+    if parsed is None:
+        return None
+    icao, updates = parsed
+    airplane = aircraft_state.get(icao)
+    if airplane is None:
+        airplane = {'hex': icao}
+        aircraft_state[icao] = airplane
+    airplane.update(updates)
+    airplane['last_heard'] = now
+    if 'lat' in updates:
+        return airplane
+    return None
+
+
+def forget_stale_aircraft(now):
+    stale = [icao for icao, airplane in aircraft_state.items()
+             if airplane['last_heard'] + constants.sbs_aircraft_timeout < now]
+    for icao in stale:
+        del aircraft_state[icao]
+
+
+def stream_batches(host, port):
+    # yields a list of in-range aircraft (possibly empty) every sbs_batch_interval seconds, for as long as we can
+    #  stay connected. Reconnects after sbs_reconnect_delay if the stream drops
+    while True:
+        try:
+            logger.info("Connecting to SBS-1 stream at %s:%d", host, port)
+            with socket.create_connection((host, port), timeout=constants.http_connect_timeout) as connection:
+                connection.settimeout(constants.sbs_batch_interval)
+                for batch in _read_batches(connection):
+                    yield batch
+            logger.warning("SBS-1 stream closed")
+        except OSError as e:
+            logger.warning("SBS-1 stream error: %s", e)
+        time.sleep(constants.sbs_reconnect_delay)
+
+
+def _read_batches(connection):
+    buffer = b''
+    moved = {}
+    batch_started = time.monotonic()
+    while True:
+        try:
+            chunk = connection.recv(65536)
+            if chunk == b'':
+                # the other end hung up. Pass on whatever moved before it did
+                if moved.__len__():
+                    yield helper_functions.filter_airspace(list(moved.values()))
+                return
+            buffer += chunk
+            lines = buffer.split(b'\n')
+            # the last piece may be a partial line, keep it for the next read
+            buffer = lines.pop()
+            now = time.time()
+            for line in lines:
+                airplane = apply_line(line.decode('ascii', errors='replace'), now)
+                if airplane is not None:
+                    moved[airplane['hex']] = airplane
+        except socket.timeout:
+            pass
+
+        if time.monotonic() - batch_started >= constants.sbs_batch_interval:
+            # only the aircraft that moved since the last batch need an airspace check
+            in_range = helper_functions.filter_airspace(list(moved.values()))
+            moved = {}
+            forget_stale_aircraft(time.time())
+            batch_started = time.monotonic()
+            yield in_range
+
+
+def replay(capture_name, port, speed=1.0):
+    # serve a captured SBS-1 stream on a local port, for testing the streaming ingest without an antenna
+    #  capture lines are sent in order, paced by the generated timestamps in the capture, sped up by speed
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', port))
+    server.listen(1)
+    print("Replaying " + capture_name + " on port " + str(port))
+    while True:
+        connection, address = server.accept()
+        print("Client connected from " + str(address))
+        try:
+            with open(capture_name, 'rb') as capture:
+                previous = None
+                for line in capture:
+                    fields = line.split(b',')
+                    if fields.__len__() > 7 and speed > 0:
+                        try:
+                            stamp = time.mktime(time.strptime((fields[6] + b' ' + fields[7].split(b'.')[0]).decode(),
+                                                              '%Y/%m/%d %H:%M:%S'))
+                            if previous is not None and stamp > previous:
+                                time.sleep((stamp - previous) / speed)
+                            previous = stamp
+                        except ValueError:
+                            pass
+                    connection.sendall(line.rstrip(b'\r\n') + b'\r\n')
+        except OSError as e:
+            print("Client disconnected: " + str(e))
+        finally:
+            connection.close()
+
+
+if __name__ == "__main__":
+    # usage: python3 sbs_stream.py capture.txt [port] [speed]
+    replay(sys.argv[1], int(sys.argv[2]) if sys.argv.__len__() > 2 else 30003,
+           float(sys.argv[3]) if sys.argv.__len__() > 3 else 1.0)
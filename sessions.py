@@ -0,0 +1,50 @@
+import logging
+import time
+import constants
+import database
+
+logger = logging.getLogger("sessions")
+
+# aircraft currently inside (or recently inside) our airspace, keyed by ICAO hex code
+#  each entry: {'squawk': str, 'entered': epoch int, 'last_seen': epoch int}
+# this mirrors the newest sightings row for each hex (keyed on icao code and entered) so the dedup check never needs
+#  to hit the database
+active = {}
+_loaded = False
+
+
+def load():
+    # cold start. Pull every entry that could still be inside the squawk_delay window out of the database
+    #  anything left over from before (e.g. another database) is forgotten
+    global _loaded
+    active.clear()
+    cutoff = int(time.time()) - constants.squawk_delay
+    query = "select icao_code, squawk, entered from sightings where entered >= (?) order by entered asc"
+    cur = database.get_connection().cursor()
+    cur.execute(query, [cutoff])
+    # rows come back oldest first, so the newest entry for each hex wins
+    for icao, squawk, entered in cur.fetchall():
+        active[icao] = {'squawk': squawk, 'entered': entered, 'last_seen': entered}
+    cur.close()
+    _loaded = True
+    logger.info("Loaded %d active aircraft sessions from database", active.__len__())
+
+
+def get(icao):
+    if not _loaded:
+        load()
+    return active.get(icao)
+
+
+def start(icao, squawk, entered):
+    active[icao] = {'squawk': squawk, 'entered': entered, 'last_seen': entered}
+
+
+def evict_expired(now=None):
+    # once squawk_delay has passed the next sighting counts as a new flight anyway, so there's no need to keep it
+    if now is None:
+        now = int(time.time())
+    expired = [icao for icao, session in active.items() if session['entered'] + constants.squawk_delay < now]
+    for icao in expired:
+        del active[icao]
+    return expired.__len__()
@@ -0,0 +1,97 @@
+import ast
+import csv
+import datetime
+import os
+import subprocess
+import sys
+
+# measures how long main.py spends importing modules before it can start polling, using python's own -X importtime
+#  output. Each run is appended to startup_report.csv so a slow new import shows up against the previous runs
+# usage: python3 startup_report.py [number of slowest imports to list]
+
+report_name = "startup_report.csv"
+# flag the run if total import time grows by more than this fraction over the previous run
+regression_threshold = 0.2
+
+
+def startup_modules(main_path):
+    # everything main.py imports before the first poll, read from main.py itself so the list can't fall behind it
+    #  modules imported inside functions (geopy, twython etc.) are loaded later on, so they're left out
+    with open(main_path) as main_file:
+        tree = ast.parse(main_file.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            modules.append(node.module)
+    return modules
+
+
+def measure_imports():
+    here = os.path.dirname(os.path.abspath(__file__))
+    modules = startup_modules(os.path.join(here, "main.py"))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + ", ".join(modules)],
+                            cwd=here, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr)
+        raise RuntimeError("Unable to import startup modules")
+
+    # lines look like "import time:       374 |     145957 | geopy.distance", nested imports are indented
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        imports.append({"name": name.strip(), "self_us": int(self_us), "cumulative_us": int(cumulative_us),
+                        "depth": depth})
+    return imports
+
+
+def previous_total(report_path):
+    if not os.path.exists(report_path):
+        return None
+    with open(report_path, newline='') as report_file:
+        rows = list(csv.DictReader(report_file))
+    if rows.__len__() == 0:
+        return None
+    return int(rows[-1]["total_us"])
+
+
+def record(report_path, total_us, slowest):
+    new_file = not os.path.exists(report_path)
+    with open(report_path, "a", newline='') as report_file:
+        writer = csv.writer(report_file)
+        if new_file:
+            writer.writerow(["timestamp", "python", "total_us", "slowest"])
+        writer.writerow([datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                         sys.version.split()[0],
+                         total_us,
+                         ";".join(entry["name"] + "=" + str(entry["cumulative_us"]) for entry in slowest)])
+
+
+def main():
+    show = int(sys.argv[1]) if sys.argv.__len__() > 1 else 10
+    imports = measure_imports()
+    top_level = [entry for entry in imports if entry["depth"] == 0]
+    total_us = sum(entry["cumulative_us"] for entry in top_level)
+    slowest = sorted(top_level, key=lambda entry: entry["cumulative_us"], reverse=True)[:show]
+
+    print("Startup import time: " + str(round(total_us / 1000, 1)) + " ms")
+    for entry in slowest:
+        print("  " + str(round(entry["cumulative_us"] / 1000, 1)).rjust(8) + " ms  " + entry["name"])
+
+    report_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), report_name)
+    last_total = previous_total(report_path)
+    record(report_path, total_us, slowest)
+
+    if last_total is not None and total_us > last_total * (1 + regression_threshold):
+        print("Import time regression: " + str(round(last_total / 1000, 1)) + " ms -> " +
+              str(round(total_us / 1000, 1)) + " ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
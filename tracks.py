@@ -0,0 +1,141 @@
+import array
+import logging
+import struct
+import sys
+import time
+import zlib
+import constants
+import database
+import sessions
+
+logger = logging.getLogger("tracks")
+
+# position history for each pass through our airspace. Points are kept in compact typed arrays while the aircraft is
+#  in range, and once it leaves the whole pass is packed into a single compressed blob in the track table and the
+#  sighting's exit time is filled in. Everything goes out with the rest of the cycle's writes, never one per point
+# units are as dump1090 reports them: degrees, feet, knots
+
+# bump this if the blob layout changes, so old passes can still be read
+track_format = 1
+# header: format, number of points
+_header = struct.Struct('<BI')
+
+# icao hex -> Track for every aircraft currently being tracked
+open_tracks = {}
+
+
+class Track:
+    __slots__ = ('icao', 'entered', 'started', 'last_seen', 'times', 'lats', 'lons', 'altitudes', 'speeds',
+                 'headings')
+
+    def __init__(self, icao, entered, started):
+        # (icao, entered) is the sightings row this track belongs to
+        self.icao = icao
+        self.entered = entered
+        self.started = started
+        self.last_seen = started
+        # seconds since started, then one float32 per point for each value. Missing values are NaN
+        self.times = array.array('I')
+        self.lats = array.array('f')
+        self.lons = array.array('f')
+        self.altitudes = array.array('f')
+        self.speeds = array.array('f')
+        self.headings = array.array('f')
+
+    def add(self, airplane, now):
+        # the times array is unsigned. If the wall clock steps back (e.g. NTP catching up on a Pi with no RTC), the
+        #  point is pinned to the start of the track rather than crashing the poll loop
+        self.times.append(max(0, now - self.started))
+        self.lats.append(airplane['lat'])
+        self.lons.append(airplane['lon'])
+        altitude = airplane.get('alt_baro')
+        # dump1090 reports "ground" rather than a number for aircraft on the ground
+        if altitude == "ground":
+            altitude = 0
+        self.altitudes.append(float('nan') if altitude is None else altitude)
+        self.speeds.append(airplane.get('gs', float('nan')))
+        self.headings.append(airplane.get('track', float('nan')))
+        self.last_seen = now
+
+    def columns(self):
+        return [self.times, self.lats, self.lons, self.altitudes, self.speeds, self.headings]
+
+    def pack(self):
+        # column by column rather than point by point, which compresses much better
+        body = b''
+        for column in self.columns():
+            if sys.byteorder == 'big':
+                column = array.array(column.typecode, column)
+                column.byteswap()
+            body += column.tobytes()
+        return _header.pack(track_format, self.times.__len__()) + zlib.compress(body)
+
+
+def unpack(blob, started=0):
+    # returns a list of (epoch time, lat, lon, altitude, speed, heading) tuples from a track table blob
+    version, points = _header.unpack_from(blob)
+    if version != track_format:
+        raise ValueError("Unknown track format " + str(version))
+    body = zlib.decompress(blob[_header.size:])
+    columns = []
+    offset = 0
+    for typecode in 'Ifffff':
+        column = array.array(typecode)
+        size = column.itemsize * points
+        column.frombytes(body[offset:offset + size])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        columns.append(column)
+        offset += size
+    return [(started + point[0],) + point[1:] for point in zip(*columns)]
+
+
+def record_positions(in_range, now=None):
+    # add a point for every in-range aircraft that has a sightings entry to attach it to
+    if now is None:
+        now = int(time.time())
+    for airplane in in_range:
+        session = sessions.get(airplane['hex'])
+        if session is None:
+            continue
+        track = open_tracks.get(airplane['hex'])
+        if track is not None and track.entered != session['entered']:
+            # a new sightings entry (new flight, or new squawk) starts a new track
+            close(track)
+            track = None
+        if track is None:
+            track = Track(airplane['hex'], session['entered'], now)
+            open_tracks[airplane['hex']] = track
+        track.add(airplane, now)
+        # don't let an aircraft that never leaves (e.g. circling overhead all day) grow without limit
+        if track.times.__len__() >= constants.track_max_points:
+            close(track)
+
+
+def close(track):
+    # queue the packed track and the aircraft's exit time, to be written with the rest of this cycle's writes
+    exited = track.last_seen
+    if open_tracks.get(track.icao) is track:
+        del open_tracks[track.icao]
+    database.queue_write("insert or replace into track values (?,?,?,?,?,?)",
+                         [track.icao, track.entered, track.started, exited, track.times.__len__(), track.pack()])
+    database.queue_write("update sightings set exited = (?) where icao_code = (?) and entered = (?)",
+                         [exited, track.icao, track.entered])
+    logger.debug("%s: track closed with %d points", track.icao, track.times.__len__())
+
+
+def close_exited(now=None):
+    # anything we haven't had an in-range position for in track_exit_timeout seconds has left our airspace
+    #  (or the feed). Its exit time is the last position we had for it
+    if now is None:
+        now = int(time.time())
+    exited = [track for track in open_tracks.values() if track.last_seen + constants.track_exit_timeout < now]
+    for track in exited:
+        close(track)
+    return exited.__len__()
+
+
+def close_all():
+    # on shutdown. Whatever we have so far is better than nothing
+    for track in list(open_tracks.values()):
+        close(track)
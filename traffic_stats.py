@@ -0,0 +1,215 @@
+import argparse
+import datetime
+import logging
+import sys
+import time
+import numpy
+import constants
+import database
+import helper_functions
+import tweet_dispatcher
+
+logger = logging.getLogger("traffic_stats")
+
+# traffic statistics over the whole sightings history. Rather than scanning every sighting for each report, counts
+#  per day are kept in the traffic_stats table and bumped as each sighting is committed, so a report over years of
+#  data only adds up a few thousand small rows. Days are local time
+# usage: python3 traffic_stats.py [report|daily|rebuild] (see --help)
+
+# counts are broken down by dimension: total (a single empty value per day), hour, aircraft_type, airline and
+#  direction (the compass point the aircraft came in from)
+stats_upsert = "insert into traffic_stats values (?,?,?,?) " \
+               "on conflict(dimension, day, value) do update set sightings = sightings + excluded.sightings"
+
+# the last day we tweeted (or decided not to tweet) a summary for, so the database is only asked once a day
+_summary_day = None
+
+
+def stats_keys(entered, aircraft_type, airline_code, direction):
+    # the (dimension, day, value) rows one sighting counts towards
+    local = time.localtime(entered)
+    day = time.strftime('%Y-%m-%d', local)
+    keys = [("total", day, ""), ("hour", day, time.strftime('%H', local)), ("direction", day, direction)]
+    # 'none' and 'Unknown' mean FlightAware couldn't tell us the type
+    if aircraft_type is not None and aircraft_type not in ("none", "Unknown"):
+        keys.append(("aircraft_type", day, aircraft_type))
+    if airline_code is not None:
+        keys.append(("airline", day, airline_code))
+    return keys
+
+
+def record(flight_dict):
+    # count a newly committed sighting. Written with the rest of the cycle's writes
+    direction = helper_functions.heading_to_direction(
+        helper_functions.get_bearing(constants.home, (flight_dict['lat'], flight_dict['lon'])))
+    for key in stats_keys(flight_dict['entered'], flight_dict['aircraft'], flight_dict['airline_code'], direction):
+        database.queue_write(stats_upsert, list(key) + [1])
+
+
+def load():
+    # the stats table starts out empty when it's first created. Fill it in from the existing history once
+    conn = database.get_connection()
+    with database.lock:
+        has_stats = conn.execute("select 1 from traffic_stats limit 1").fetchone() is not None
+        has_sightings = conn.execute("select 1 from sightings limit 1").fetchone() is not None
+    if has_sightings and not has_stats:
+        rebuild()
+
+
+def rebuild():
+    # recount everything from the sightings table. Only needed once, or if the counts are ever in doubt
+    #  sightings are read in chunks so years of history don't all have to fit in memory on a Pi
+    started = time.perf_counter()
+    conn = database.get_connection()
+    counts = {}
+    sightings = 0
+    with database.lock:
+        database.flush()
+        cur = conn.execute("select entered, aircraft, airline_code, lat, lon from sightings")
+        while True:
+            rows = cur.fetchmany(constants.stats_rebuild_chunk)
+            if rows.__len__() == 0:
+                break
+            directions = helper_functions.headings_to_directions(
+                helper_functions.get_bearings(constants.home,
+                                              numpy.array([row[3] for row in rows], dtype=float),
+                                              numpy.array([row[4] for row in rows], dtype=float)))
+            for row, direction in zip(rows, directions):
+                for key in stats_keys(row[0], row[1], row[2], direction):
+                    counts[key] = counts.get(key, 0) + 1
+            sightings += rows.__len__()
+        cur.close()
+        conn.execute("delete from traffic_stats")
+        conn.executemany("insert into traffic_stats values (?,?,?,?)",
+                         [list(key) + [count] for key, count in counts.items()])
+        conn.commit()
+    logger.info("Traffic stats rebuilt from %d sightings in %.1f s", sightings, time.perf_counter() - started)
+
+
+def totals(dimension, first_day, last_day, limit=None):
+    # (value, sightings) pairs over the days first_day to last_day inclusive (YYYY-mm-dd), biggest first
+    query = "select value, sum(sightings) as total from traffic_stats " \
+            "where dimension = (?) and day between (?) and (?) group by value order by total desc, value"
+    if limit is not None:
+        query += " limit " + str(int(limit))
+    with database.lock:
+        return database.get_connection().execute(query, [dimension, first_day, last_day]).fetchall()
+
+
+def daily_totals(first_day, last_day):
+    query = "select day, sightings from traffic_stats where dimension = 'total' and day between (?) and (?) " \
+            "order by day"
+    with database.lock:
+        return database.get_connection().execute(query, [first_day, last_day]).fetchall()
+
+
+def summary(first_day, last_day, top=5):
+    total = totals("total", first_day, last_day)
+    return {"first_day": first_day,
+            "last_day": last_day,
+            "total": total[0][1] if total.__len__() else 0,
+            "hour": totals("hour", first_day, last_day),
+            "aircraft_type": totals("aircraft_type", first_day, last_day, top),
+            "airline": totals("airline", first_day, last_day, top),
+            "direction": totals("direction", first_day, last_day)}
+
+
+def format_counts(counts):
+    return ", ".join(value + " (" + str(count) + ")" for value, count in counts)
+
+
+def daily_summary_message(day):
+    # the text of the summary tweet for one day, or None if nothing flew over
+    report = summary(day, day, top=3)
+    if report['total'] == 0:
+        return None
+    message = "Daily summary for " + day + "\n"
+    message += str(report['total']) + " aircraft overhead\n"
+    busiest_hour, busiest_count = report['hour'][0]
+    message += "Busiest hour: " + busiest_hour + ":00 (" + str(busiest_count) + ")\n"
+    if report['aircraft_type'].__len__():
+        message += "Top types: " + format_counts(report['aircraft_type']) + "\n"
+    if report['airline'].__len__():
+        message += "Top airlines: " + format_counts(report['airline']) + "\n"
+    direction, direction_count = report['direction'][0]
+    message += "Mostly from the " + direction + " (" + str(direction_count) + ")\n"
+    message += constants.hashtags + "\n"
+    if message.__len__() > 278:
+        message = message[:277]
+    return message
+
+
+def maybe_tweet_daily_summary(now=None):
+    # once a day, after daily_summary_hour, tweet the summary for the day before. Returns True if one was queued
+    global _summary_day
+    if not constants.daily_summary_tweet:
+        return False
+    if now is None:
+        now = time.time()
+    if time.localtime(now).tm_hour < constants.daily_summary_hour:
+        return False
+    day = (datetime.date.fromtimestamp(now) - datetime.timedelta(days=1)).isoformat()
+    if day == _summary_day:
+        return False
+    _summary_day = day
+    with database.lock:
+        already_sent = database.get_connection().execute("select 1 from summary_tweets where day = (?)",
+                                                         [day]).fetchone() is not None
+    if already_sent:
+        return False
+    # marked as done up front. A summary that fails to send isn't worth retrying a day late
+    database.queue_write("insert or ignore into summary_tweets values (?,?)", [day, int(now)])
+    message = daily_summary_message(day)
+    if message is None:
+        return False
+    return tweet_dispatcher.enqueue(("summary", day), "daily summary", message, record_status=False)
+
+
+def print_report(report, days):
+    print("Traffic from " + report['first_day'] + " to " + report['last_day'] + ": " + str(report['total']) +
+          " aircraft")
+    print("  per day:       " + ", ".join(day + " (" + str(count) + ")" for day, count in days))
+    print("  per hour:      " + format_counts(sorted(report['hour'])))
+    print("  top types:     " + format_counts(report['aircraft_type']))
+    print("  top airlines:  " + format_counts(report['airline']))
+    print("  from:          " + format_counts(report['direction']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Traffic statistics from the piaware-alerts database")
+    parser.add_argument("command", nargs="?", default="report", choices=["report", "daily", "rebuild"],
+                        help="report over a range of days, print one day's summary tweet, or recount everything "
+                             "from the sightings table (stop the bot first)")
+    parser.add_argument("--days", type=int, default=7, help="report on this many days up to and including today")
+    parser.add_argument("--from", dest="first_day", help="first day to report on (YYYY-mm-dd)")
+    parser.add_argument("--to", dest="last_day", help="last day to report on (YYYY-mm-dd), or the day for daily")
+    parser.add_argument("--top", type=int, default=10, help="how many aircraft types and airlines to list")
+    args = parser.parse_args()
+
+    today = datetime.date.today()
+    helper_functions.create_sql_tables()
+    try:
+        if args.command == "rebuild":
+            rebuild()
+            return 0
+        load()
+        if args.command == "daily":
+            day = args.last_day or (today - datetime.timedelta(days=1)).isoformat()
+            print(daily_summary_message(day) or "No aircraft on " + day)
+            return 0
+        last_day = args.last_day or today.isoformat()
+        first_day = args.first_day or (datetime.date.fromisoformat(last_day) -
+                                       datetime.timedelta(days=args.days - 1)).isoformat()
+        started = time.perf_counter()
+        report = summary(first_day, last_day, args.top)
+        days = daily_totals(first_day, last_day)
+        elapsed = time.perf_counter() - started
+        print_report(report, days)
+        print("(" + str(round(elapsed * 1000, 1)) + " ms)")
+        return 0
+    finally:
+        database.close_connection()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import constants
+import database
+import helper_functions
+import metrics
+
+logger = logging.getLogger("tweet_dispatcher")
+
+# sends composed tweets from a background thread, so a slow or failing Twitter API never holds up the poll loop
+#  tweets are rate limited with a token bucket, retried with backoff, and their tweet_status updates are written to
+#  the database in bulk. FlightAware links are shortened here too, so bitly's round trip stays off the poll loop as well
+
+_queue = queue.Queue()
+# (icao_code, entered) keys of the sightings that are queued or in flight. tweet() skips these so an aircraft isn't
+#  queued twice while it waits
+pending = set()
+_pending_lock = threading.Lock()
+_stop = threading.Event()
+_thread = None
+# stands in for the short link in a composed tweet until the dispatcher has one
+link_marker = "{details_link}"
+
+
+class TokenBucket:
+    def __init__(self, capacity, refill_seconds):
+        # allows bursts of up to capacity tweets, then one more every refill_seconds
+        self.capacity = capacity
+        self.refill_seconds = refill_seconds
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def wait_time(self):
+        # how long until a token is available. Zero means go ahead now
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) / self.refill_seconds)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) * self.refill_seconds
+
+    def take(self):
+        self.tokens -= 1
+
+
+def is_pending(aircraft_key):
+    with _pending_lock:
+        return aircraft_key in pending
+
+
+def enqueue(aircraft_key, icao, message, record_status=True, url=None):
+    # record_status=False is for tweets that aren't about a sighting (e.g. the daily summary), so there's no
+    #  tweet_status to set once they're out
+    # url is shortened just before sending, and takes the place of link_marker in the message
+    with _pending_lock:
+        if aircraft_key in pending:
+            return False
+        pending.add(aircraft_key)
+    _queue.put((aircraft_key, icao, message, record_status, url))
+    return True
+
+
+def start():
+    global _thread
+    if _thread is None or not _thread.is_alive():
+        _stop.clear()
+        _thread = threading.Thread(target=_run, name="tweet-dispatcher", daemon=True)
+        _thread.start()
+
+
+def stop(timeout=None):
+    # let whatever is in flight finish, then record any outstanding statuses
+    if timeout is None:
+        timeout = constants.tweet_shutdown_timeout
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout)
+
+
+def _record_sent(sent_keys):
+    if sent_keys.__len__() == 0:
+        return
+    update_query = "update sightings set tweet_status = 1 where icao_code = (?) and entered = (?)"
+    # committed straight away. Until it is, the keys stay pending so tweet() can't queue them again, and if the commit
+    #  fails they're kept for the next try rather than lost (which would send the tweets twice)
+    try:
+        with database.lock:
+            database.get_connection().executemany(update_query, sent_keys)
+            database.flush()
+    except sqlite3.Error as e:
+        logger.warning("Unable to record %d tweet statuses, will try again: %s", sent_keys.__len__(), e)
+        return
+    with _pending_lock:
+        pending.difference_update(sent_keys)
+    logger.info("%d tweet statuses updated in database", sent_keys.__len__())
+    sent_keys.clear()
+
+
+def fill_in_link(message, url):
+    # swap the marker for the short link, or drop the line if there's no link to be had
+    link = None
+    if url is not None:
+        try:
+            link = helper_functions.shorten_link(url)
+        except Exception as e:
+            logger.warning("Error shortening %s: %s", url, e)
+    if link is None:
+        message = message.replace("Details: " + link_marker + "\n", "")
+    else:
+        message = message.replace(link_marker, link)
+    # super ugly temp fix. tweet should be split into 2 messages.
+    if message.__len__() > 278:
+        message = message[:277]
+    return message
+
+
+def _send(icao, message):
+    # returns True once the tweet is out, False if we gave up on it
+    delay = constants.tweet_retry_delay
+    for attempt in range(1, constants.tweet_max_attempts + 1):
+        try:
+            metrics.count_api_call("Twitter")
+            helper_functions.get_twitter_client().update_status(status=message)
+            logger.info("%s: tweet sent", icao)
+            return True
+        except Exception as e:
+            logger.warning("%s: error tweeting (attempt %d): %s", icao, attempt, e)
+            last_error = e
+        if attempt < constants.tweet_max_attempts:
+            # don't wait out the backoff if we're shutting down
+            if _stop.wait(delay):
+                break
+            delay *= 2
+    try:
+        helper_functions.email_problem("Unable to tweet for " + icao + ": " + str(last_error))
+    except Exception as e:
+        logger.error("Error sending problem email: %s", e)
+    return False
+
+
+def _run():
+    bucket = TokenBucket(constants.tweet_burst, constants.tweet_refill_seconds)
+    sent_keys = []
+    while True:
+        try:
+            aircraft_key, icao, message, record_status, url = _queue.get(timeout=1)
+        except queue.Empty:
+            # nothing waiting, a good time to write out what's been sent
+            _record_sent(sent_keys)
+            if _stop.is_set():
+                return
+            continue
+
+        if _stop.is_set():
+            # shutting down. Leave the rest for the next run, they're still untweeted in the database
+            with _pending_lock:
+                pending.discard(aircraft_key)
+            continue
+
+        try:
+            wait = bucket.wait_time()
+            if wait > 0:
+                logger.info("Tweet rate limit reached. Waiting %d seconds", wait)
+                if _stop.wait(wait):
+                    # shutting down. Leave this one for the next run, it's still untweeted in the database
+                    with _pending_lock:
+                        pending.discard(aircraft_key)
+                    continue
+                bucket.wait_time()
+            bucket.take()
+            if _send(icao, fill_in_link(message, url)):
+                if record_status:
+                    sent_keys.append(aircraft_key)
+                else:
+                    with _pending_lock:
+                        pending.discard(aircraft_key)
+            else:
+                # give up for now. It's still untweeted in the database so a later cycle will queue it again
+                with _pending_lock:
+                    pending.discard(aircraft_key)
+            # write the statuses out once the queue runs dry, or a full batch has gone out
+            if _queue.empty() or sent_keys.__len__() >= constants.tweet_batch_size:
+                _record_sent(sent_keys)
+        except Exception as e:
+            logger.exception("Tweet dispatcher error")
+            with _pending_lock:
+                pending.discard(aircraft_key)
@@ -0,0 +1,107 @@
+import logging
+import threading
+import time
+import requests
+import constants
+import database
+import http_client
+import metrics
+
+logger = logging.getLogger("weather")
+
+# the current weather, held in memory. It's read from the weather table once at startup, and from then on refreshed
+#  from OWM on a background thread whenever it goes stale, so the poll loop never waits on OWM or the database
+# expiry is tracked on the monotonic clock, so a wall clock change (e.g. NTP catching up on a Pi with no RTC) can't
+#  make it look fresher or staler than it really is
+
+# {"visibility": feet, "desc": str, "timestamp": formatted observation time}, or None until we have any weather
+current = None
+# time.monotonic() values: when the current observation becomes older than weather_interval, and when we're next
+#  allowed to ask OWM (weather_api_check_frequency after the last attempt)
+_stale_at = 0.0
+_next_check_at = 0.0
+_refreshing = False
+_loaded = False
+_lock = threading.Lock()
+
+
+def _monotonic_at(epoch):
+    # convert a unix time (as stored in the weather table) into the matching time.monotonic() value
+    return time.monotonic() + (epoch - time.time())
+
+
+def _describe(observed, desc, visibility):
+    return {"visibility": int(visibility * constants.meters_to_feet),
+            "desc": desc,
+            "timestamp": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(observed))}
+
+
+def load():
+    # cold start. The newest row in the weather table is the current weather until the first refresh
+    global current, _stale_at, _next_check_at, _loaded
+    with database.lock:
+        newest = database.get_connection().execute("select datetime, desc, visibility, lastchecked from weather "
+                                                   "order by datetime desc limit 1").fetchone()
+    with _lock:
+        if newest is None:
+            # a brand new database. Ask OWM straight away
+            current = None
+            _stale_at = 0.0
+            _next_check_at = 0.0
+        else:
+            current = _describe(newest[0], newest[1], newest[2])
+            _stale_at = _monotonic_at(newest[0] + constants.weather_interval)
+            _next_check_at = _monotonic_at(newest[3] + constants.weather_api_check_frequency)
+        _loaded = True
+
+
+def get():
+    # never blocks on the network. If the weather is stale and OWM hasn't been asked recently, a refresh is started
+    #  in the background and the weather we already have is returned in the meantime
+    global _refreshing
+    if not _loaded:
+        load()
+    now = time.monotonic()
+    with _lock:
+        if now >= _stale_at and now >= _next_check_at and not _refreshing:
+            _refreshing = True
+            logger.debug("Weather info is stale. Refreshing from OWM in the background")
+            threading.Thread(target=refresh, name="weather-refresh", daemon=True).start()
+        return current
+
+
+def refresh():
+    global current, _stale_at, _next_check_at, _refreshing
+    try:
+        logger.info("Querying info from OWM API")
+        metrics.count_api_call("OWM")
+        data = http_client.get_json(constants.OWM_URL)
+        # visibility is a calculated value and OWM may not always return it. We must handle this scenario
+        vis = data.get('visibility', -1)
+        checked = int(time.time())
+        weather_values = [data['dt'],
+                          data['coord']['lat'],
+                          data['coord']['lon'],
+                          data['weather'][0]['description'],
+                          data['main']['temp'],
+                          data['main']['pressure'],
+                          data['main']['humidity'],
+                          vis,
+                          checked
+                          ]
+        # kept for the next startup, and written with the rest of the poll cycle's writes
+        database.queue_write("insert or replace into weather values (?,?,?,?,?,?,?,?,?);", weather_values)
+        with _lock:
+            current = _describe(data['dt'], data['weather'][0]['description'], vis)
+            _stale_at = _monotonic_at(data['dt'] + constants.weather_interval)
+    except requests.exceptions.HTTPError as e:
+        logger.warning("OWM HTTP Error: %s", e)
+    except requests.exceptions.ConnectionError as e:
+        logger.warning("OWM URL Error: %s - Check network connections", e)
+    except Exception as e:
+        logger.exception("Error reaching %s", constants.OWM_URL)
+    finally:
+        # successful or not, OWM only gets asked once per weather_api_check_frequency
+        with _lock:
+            _next_check_at = time.monotonic() + constants.weather_api_check_frequency
+            _refreshing = False